@@ -18,6 +18,8 @@
 #
 
 
+import asyncio
+import concurrent.futures
 import uuid
 import typing
 
@@ -53,6 +55,10 @@ class ControllerMissing(Exception):
 
 class BaseSender(object):
     def __init__(self, *args, **kwargs):
+        # threads are started lazily on the first submit
+        self._send_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"foris-client-{type(self).__name__}"
+        )
         self.connect(*args, **kwargs)
 
     def connect(self, *args, **kwargs):
@@ -61,9 +67,33 @@ class BaseSender(object):
     def send(self, module, action, data, timeout=None, controller_id=None):
         raise NotImplementedError()
 
+    def send_async(
+        self, module, action, data, timeout=None, controller_id=None
+    ) -> concurrent.futures.Future:
+        """ Sends the request without waiting for the reply
+
+        Default implementation performs the requests one by one in a background thread.
+
+        :returns: future which contains the reply or the exception raised by send()
+        """
+        try:
+            return self._send_executor.submit(
+                self.send, module, action, data, timeout=timeout, controller_id=controller_id
+            )
+        except RuntimeError:
+            # executor was shut down by disconnect()
+            future = concurrent.futures.Future()
+            future.set_exception(ConnectionError("Sender is disconnected."))
+            return future
+
     def disconnect(self):
         raise NotImplementedError()
 
+    def _shutdown_send_executor(self):
+        """ Stops the thread of send_async() and cancels the requests which were not sent yet
+        """
+        self._send_executor.shutdown(wait=False, cancel_futures=True)
+
     def _raise_exception_on_error(self, msg):
         if "errors" in msg:
             raise generate_controller_error(msg["module"], msg["action"])(msg["errors"])
@@ -81,3 +111,84 @@ class BaseListener(object):
 
     def disconnect(self):
         raise NotImplementedError()
+
+
+class AsyncBaseSender(object):
+    """ Base class for senders which are used within an asyncio event loop
+
+    The connection can't be established in the constructor, so the sender
+    has to be awaited (`sender = await Sender(...)`) or used as an async context manager.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._connect_args = args
+        self._connect_kwargs = kwargs
+
+    def __await__(self):
+        async def connect():
+            await self.connect(*self._connect_args, **self._connect_kwargs)
+            return self
+
+        return connect().__await__()
+
+    async def __aenter__(self):
+        return await self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    async def connect(self, *args, **kwargs):
+        raise NotImplementedError()
+
+    async def send(self, module, action, data, timeout=None, controller_id=None):
+        raise NotImplementedError()
+
+    async def disconnect(self):
+        raise NotImplementedError()
+
+    _raise_exception_on_error = BaseSender._raise_exception_on_error
+
+
+class AsyncBaseListener(object):
+    """ Base class for listeners which are used within an asyncio event loop
+
+    Notifications are obtained by iterating over the listener
+    (`async for msg, controller_id in listener`). The iteration ends after disconnect().
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._connect_args = args
+        self._connect_kwargs = kwargs
+
+    def __await__(self):
+        async def connect():
+            self._notifications: asyncio.Queue = asyncio.Queue()
+            await self.connect(*self._connect_args, **self._connect_kwargs)
+            return self
+
+        return connect().__await__()
+
+    async def __aenter__(self):
+        return await self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    async def __aiter__(self):
+        while True:
+            item = await self._notifications.get()
+            if item is None:
+                return
+            yield item
+
+    def _notify(self, msg: dict, controller_id: str):
+        self._notifications.put_nowait((msg, controller_id))
+
+    def _stop_notifications(self):
+        self._notifications.put_nowait(None)
+
+    async def connect(self, *args, **kwargs):
+        raise NotImplementedError()
+
+    async def disconnect(self):
+        raise NotImplementedError()
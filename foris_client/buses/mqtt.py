@@ -17,20 +17,33 @@
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 #
 
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
 import logging
 import uuid
-import json
 import threading
 import time
 import ssl
 import queue
-import re
 import typing
 
-from .base import BaseSender, BaseListener, ControllerMissing, prepare_controller_id
+from .. import codec
+from .base import (
+    AsyncBaseListener,
+    AsyncBaseSender,
+    BaseListener,
+    BaseSender,
+    ControllerMissing,
+    prepare_controller_id,
+)
+from ..utils import OVERFLOW_BLOCK, ExpiryIndex, OrderedDispatcher, Scheduler, TopicRouter
 
 from paho import mqtt as mqtt_module
 from paho.mqtt import client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from typing import Optional
 
 
@@ -46,126 +59,522 @@ def mqtt_client_extra():
 ANNOUNCER_PERIOD_REQUIRED = 5.0  # in seconds
 CONNECT_TIMEOUT = 15  # in seconds
 RETENTION_TIMEOUT = 30  # in seconds
+PUBLISH_TIMEOUT = 0.3  # in seconds
+EXPIRY_BATCH = 32  # max number of expired replies removed while processing a single message
+RESEND_GRACE = 1.0  # in seconds, min age of a request which is resent when it is missing in working_replies
 
 logger = logging.getLogger(__name__)
 
+_END = object()  # end of an iterator (None is a valid controller_id)
+
 
 def _normalize_timeout(timeout):
     return float(timeout or 0) / 1000
 
 
+def prepare_client(
+    client_id: str,
+    tls_files: typing.List[str],
+    credentials: Optional[typing.Tuple[str, str]],
+    protocol: int = mqtt.MQTTv311,
+) -> mqtt.Client:
+    if protocol == mqtt.MQTTv5:
+        # clean_session is replaced by clean_start (passed to connect) in MQTT v5
+        client = mqtt.Client(client_id=client_id, protocol=protocol, **mqtt_client_extra())
+    else:
+        client = mqtt.Client(client_id=client_id, clean_session=False, **mqtt_client_extra())
+
+    if tls_files:
+        ca_path, cert_path, key_path = tls_files
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        context.load_cert_chain(cert_path, key_path)
+        context.load_verify_locations(ca_path)
+        context.verify_mode = ssl.CERT_REQUIRED
+        # can't assume that server cert is issued to particular hostname/ipaddress
+        context.check_hostname = False
+        client.tls_set_context(context)
+
+    if credentials:
+        client.username_pw_set(*credentials)
+
+    return client
+
+
+def controller_shard(controller_id: str, count: int) -> int:
+    """ Returns the shard of the controller (stable across the processes unlike hash())
+
+    crc32 is not used as it spreads ids which differ in a single character poorly.
+    """
+    digest = hashlib.blake2b(controller_id.encode("utf8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def check_controller(controller: Optional[dict], controller_id: str, reply_id: str) -> bool:
+    """ Checks whether the controller is alive and is processing the request
+
+    :returns: False if the request should be resent
+    :raises ControllerMissing: when controller is not alive
+    """
+    if not controller:
+        # controller hasn't appear yet
+        raise ControllerMissing(controller_id)
+    if controller["last"] < time.monotonic() - ANNOUNCER_PERIOD_REQUIRED:
+        # controller is not alive
+        raise ControllerMissing(controller_id)
+    if reply_id not in controller["working_replies"]:
+        # message is not being processed by the controller
+        return False
+    # otherwise controller is performing some long lasting task and hasn't replied yet
+    return True
+
+
+class ControllerRegistry(object):
+    """ Controllers which advertise themselves on the message bus
+
+    A controller is online while its advertisements keep coming (at least once
+    per ANNOUNCER_PERIOD_REQUIRED). Records of offline controllers are kept
+    for RETENTION_TIMEOUT. Both transitions are driven by time indexes
+    and the scheduler, so the records are never scanned as a whole.
+    """
+
+    def __init__(self, scheduler: Scheduler):
+        self._lock = threading.Lock()
+        self._controllers: typing.Dict[str, dict] = {}
+        self._online_expiry = ExpiryIndex()
+        self._retention_expiry = ExpiryIndex()
+        self._callbacks: typing.List[typing.Callable[[str, bool], None]] = []
+        self._advertisement_callbacks: typing.List[typing.Callable[[str, bool], None]] = []
+        self._scheduler = scheduler
+        self._scheduled: Optional[float] = None
+
+    def add_callback(
+        self, callback: typing.Callable[[str, bool], None], advertisements: bool = False
+    ):
+        """ Registers a callback which is called on online/offline transitions
+
+        It is called as callback(controller_id, online) from the thread
+        which processes the messages or from the scheduler thread.
+
+        :param advertisements: call it on every advertisement (with online=True) as well
+        """
+        with self._lock:
+            if advertisements:
+                self._advertisement_callbacks.append(callback)
+            else:
+                self._callbacks.append(callback)
+
+    def remove_callback(self, callback: typing.Callable[[str, bool], None]):
+        with self._lock:
+            if callback in self._advertisement_callbacks:
+                self._advertisement_callbacks.remove(callback)
+            else:
+                self._callbacks.remove(callback)
+
+    def get(self, controller_id: str) -> Optional[dict]:
+        """ Returns a copy of the controller record
+
+        It contains "last" (time.monotonic() of the last advertisement),
+        "last_seen" (time.time() of the last advertisement), "working_replies" and "online".
+        """
+        with self._lock:
+            record = self._controllers.get(controller_id)
+            return dict(record) if record else None
+
+    def online(self) -> typing.List[str]:
+        """ Returns ids of the controllers which are online
+        """
+        threshold = time.monotonic() - ANNOUNCER_PERIOD_REQUIRED
+        with self._lock:
+            return [k for k, v in self._controllers.items() if v["last"] >= threshold]
+
+    def last_seen(self, controller_id: str) -> Optional[float]:
+        """ Returns time (time.time()) of the last advertisement of the controller
+        """
+        with self._lock:
+            record = self._controllers.get(controller_id)
+            return record["last_seen"] if record else None
+
+    def update(self, controller_id: str, working_replies: typing.List[str]):
+        """ Processes an advertisement of the controller
+        """
+        now = time.monotonic()
+        with self._lock:
+            record = self._controllers.get(controller_id)
+            came_online = record is None or not record["online"]
+            self._controllers[controller_id] = {
+                "last": now,
+                "last_seen": time.time(),
+                "working_replies": working_replies,
+                "online": True,
+            }
+            self._online_expiry.push(now, controller_id)
+            self._schedule(now + ANNOUNCER_PERIOD_REQUIRED)
+            callbacks = list(self._callbacks) if came_online else []
+            callbacks.extend(self._advertisement_callbacks)
+
+        for callback in callbacks:
+            self._call(callback, controller_id, True)
+
+    def _schedule(self, when: float):
+        # scheduled callbacks can't be cancelled, so only an earlier one is added
+        if self._scheduled is None or when < self._scheduled:
+            self._scheduled = when
+            self._scheduler.schedule(when, self._expire)
+
+    def _expire(self):
+        now = time.monotonic()
+        went_offline = []
+        with self._lock:
+            self._scheduled = None
+
+            for timestamp, controller_id in self._online_expiry.pop_older(
+                now - ANNOUNCER_PERIOD_REQUIRED
+            ):
+                record = self._controllers.get(controller_id)
+                # newer timestamp means that the controller has advertised meanwhile
+                if record and record["online"] and record["last"] <= timestamp:
+                    record["online"] = False
+                    went_offline.append(controller_id)
+                    self._retention_expiry.push(record["last"], controller_id)
+
+            for timestamp, controller_id in self._retention_expiry.pop_older(
+                now - RETENTION_TIMEOUT
+            ):
+                record = self._controllers.get(controller_id)
+                if record and not record["online"] and record["last"] <= timestamp:
+                    del self._controllers[controller_id]
+
+            earliest = [
+                e + period
+                for e, period in [
+                    (self._online_expiry.earliest(), ANNOUNCER_PERIOD_REQUIRED),
+                    (self._retention_expiry.earliest(), RETENTION_TIMEOUT),
+                ]
+                if e is not None
+            ]
+            if earliest:
+                self._schedule(min(earliest))
+            callbacks = self._callbacks + self._advertisement_callbacks if went_offline else []
+
+        for controller_id in went_offline:
+            for callback in callbacks:
+                self._call(callback, controller_id, False)
+
+    @staticmethod
+    def _call(callback, controller_id, online):
+        try:
+            callback(controller_id, online)
+        except Exception:
+            logger.exception("Controller registry callback %r has failed.", callback)
+
+
 class ReplyListener(threading.Thread):
+    """ Receives the replies and the advertisements (and optionally the notifications)
+
+    It runs its own client in its own thread. In the single connection mode
+    the thread is not started and its callbacks are attached to the sender client.
+
+    In the MQTT v5 mode (response_id is set) only the replies to this client are received
+    ("foris-controller/+/reply/<response_id>" with the reply_id in the correlation data).
+    Replies of the controllers which haven't replied this way yet are received using
+    per-controller subscriptions of "foris-controller/<controller_id>/reply/+".
+    """
+
+    TOPICS = [
+        "foris-controller/+/reply/+",
+        "foris-controller/+/notification/remote/action/advertize",
+    ]
+
     def __init__(
         self,
         replies: typing.Dict[typing.Tuple[str, str], list],
         replies_lock: threading.Lock,
-        controllers: typing.Dict[str, dict],
-        controllers_lock: threading.Lock,
+        replies_expiry: ExpiryIndex,
+        registry: ControllerRegistry,
         host: str,
         port: int,
         client: mqtt.Client,
+        subscribed: threading.Event,
+        on_subscribed: Optional[typing.Callable[[], None]] = None,
+        response_id: Optional[str] = None,
     ):
         self.host = host
         self.port = port
         self.client = client
+        # set when the subscriptions are acknowledged by the broker
+        self.subscribed = subscribed
+        # called after each (re)subscription
+        self.on_subscribed = on_subscribed
+        self.subscribe_mid: Optional[int] = None
+        self.subscribe_topics: typing.List[str] = []
         self.replies = replies
         self.replies_lock = replies_lock
-        self.controllers: typing.Dict[str, dict] = controllers
-        self.controllers_lock: threading.lock = controllers_lock
+        self.replies_expiry = replies_expiry
+        self.registry = registry
+        self.router = TopicRouter()
+        self.router.add(
+            "foris-controller/+/notification/remote/action/advertize", self._process_advertisement
+        )
+        self.router.add("foris-controller/+/reply/+", self._process_reply)
+        # notifications are routed separately (their filters overlap with the advertisements)
+        self.notifications = TopicRouter()
+        self.topics: typing.List[str] = list(self.TOPICS)
+        # subscription acknowledgements (mid -> event / mid -> callback of subscribe_async())
+        self.acks: typing.Dict[int, threading.Event] = {}
+        self.ack_callbacks: typing.Dict[int, typing.Callable[[], None]] = {}
+        self.acks_lock = threading.Lock()
+
+        self.response_id = response_id
+        if response_id:
+            self.topics[0] = self.response_topic("+")
+            self.router.add(self.response_topic("+"), self._process_response)
+        # controllers which are replying using MQTT v5 / legacy subscriptions of the others
+        self.v5_controllers: typing.Set[str] = set()
+        # controller_id -> callbacks waiting for the acknowledgement (None when acknowledged)
+        self.legacy: typing.Dict[str, Optional[typing.List[typing.Callable[[], None]]]] = {}
+        self.legacy_lock = threading.Lock()
         super().__init__(group=None, target=None, name="foris-client-reply-listener", daemon=True)
 
-    def run(self):
-        logger.debug("Reply listener is starting.")
-
-        def on_connect(client: mqtt.Client, userdata, flags, rc):
-            logger.debug("Client connected.")
-            client.subscribe("foris-controller/+/reply/+")
-            client.subscribe("foris-controller/+/notification/remote/action/advertize")
+    def response_topic(self, controller_id: str) -> str:
+        # placed under the controller topics so that it is covered by the controller ACLs
+        return "foris-controller/%s/reply/%s" % (controller_id, self.response_id)
 
-        def on_subscribe(client, userdata, mid, granted_qos):
-            logger.debug("Subscribed to %s.", mid)
+    def subscribe(self, topic: str, timeout: Optional[float]) -> bool:
+        """ Subscribes to the topic and waits for the acknowledgement
 
-        def on_disconnect(client, userdata, rc):
-            logger.debug("Disconneted")
+        The topic is subscribed again after reconnect.
 
-        def on_message(client, userdata, msg):
-            logger.debug("Msg recieved for '%s' (msg=%s)", msg.topic, msg.payload)
-            match = re.match(
-                r"foris-controller/([^/]+)/notification/remote/action/advertize", msg.topic
+        :returns: False when not acknowledged in time (or not connected)
+        """
+        self.topics.append(topic)
+        if not self.subscribed.is_set():
+            # it will be subscribed on connect
+            return False
+        rc, mid = self.client.subscribe(topic, qos=0)
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        with self.acks_lock:
+            # the event might exist already if the ack was faster than subscribe() returning
+            acked = self.acks.setdefault(mid, threading.Event())
+        try:
+            return acked.wait(timeout)
+        finally:
+            with self.acks_lock:
+                self.acks.pop(mid, None)
+
+    def subscribe_async(self, topic: str, callback: typing.Callable[[], None]):
+        """ Subscribes to the topic without waiting for the acknowledgement
+
+        The topic is subscribed again after reconnect.
+
+        :param callback: called when the subscription is acknowledged (from the network thread),
+                         it is not called when the topic is subscribed on (re)connect
+        """
+        self.topics.append(topic)
+        if not self.subscribed.is_set():
+            # it will be subscribed on connect
+            return
+        rc, mid = self.client.subscribe(topic, qos=0)
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            return
+        with self.acks_lock:
+            # the ack might have been faster than subscribe() returning
+            acked = self.acks.pop(mid, None)
+            if acked is None:
+                self.ack_callbacks[mid] = callback
+        if acked is not None:
+            callback()
+
+    def ensure_legacy(self, controller_id: str, callback: typing.Callable[[], None]) -> bool:
+        """ Makes sure that the replies of the controller can be received (MQTT v5 mode)
+
+        The legacy subscription is made asynchronously.
+
+        :param callback: called when the replies can be received (from the network thread),
+                         only when False is returned
+        :returns: True when the replies can be received right now
+        """
+        with self.legacy_lock:
+            if controller_id in self.v5_controllers:
+                return True
+            new = controller_id not in self.legacy
+            if new:
+                self.legacy[controller_id] = []
+            waiting = self.legacy[controller_id]
+            if waiting is None:
+                return True
+            waiting.append(callback)
+        if new:
+            self.subscribe_async(
+                "foris-controller/%s/reply/+" % controller_id,
+                functools.partial(self._legacy_acked, controller_id),
             )
-            if match:
-                # recieved a messupdate controller list
-                try:
-                    data = json.loads(msg.payload)
-                except ValueError:
-                    logger.error("Advertisement not in JSON format.")
-                    return
-                with self.controllers_lock:
-                    self.controllers[match.group(1)] = {
-                        "last": time.monotonic(),
-                        "working_replies": data["data"].get("working_replies", []),
-                    }
-                    # clean older controller records
-                    too_old = [
-                        k
-                        for k, v in self.controllers.items()
-                        if v["last"] < time.monotonic() - RETENTION_TIMEOUT
-                    ]
-                    for k in too_old:
-                        del self.controllers[k]
-                logger.debug("Msg for '%s' was processed", msg.topic)
+        return False
+
+    def _legacy_acked(self, controller_id: str):
+        with self.legacy_lock:
+            waiting = self.legacy.get(controller_id)
+            if waiting is None:
                 return
-            match = re.match(r"foris-controller/([^/]+)/reply/([^/]+)", msg.topic)
-            if match:
-                controller_id, reply_id = match.groups()
-                # Find message among replies
-                with self.replies_lock:
-                    record: typing.Optinal[
-                        typing.Tuple[float, queue.Queue, bool]
-                    ] = self.replies.get((controller_id, reply_id))
-
-                    # clean older replies
-                    too_old = [
-                        k
-                        for k, v in self.replies.items()
-                        if v[0] < time.monotonic() - RETENTION_TIMEOUT
-                    ]
-                    for k in too_old:
-                        del self.replies[k]
-
-                    if record:
-                        _, output_queue, is_processed = record
-                        if is_processed:
-                            # message is already recieved and it is being processed
-                            return
-                        else:
-                            # mark that the message is being processed
-                            self.replies[(controller_id, reply_id)][2] = True
-
-                    else:
-                        logger.debug(
-                            "Message id not found. "
-                            "(probably it is expired or doesn't belong to this client)"
-                        )
-                        return
-                # Parse and send queue the message
-                try:
-                    data = json.loads(msg.payload)
-                except ValueError:
-                    logger.error("Reply not in JSON format.")
-                    return
-                logger.debug("Sending response data '%s'", data)
-                output_queue.put(data)
-                logger.debug("Msg for '%s' was processed", msg.topic)
+            self.legacy[controller_id] = None
+        for callback in waiting:
+            callback()
+
+    def _mark_v5(self, controller_id: str):
+        with self.legacy_lock:
+            if controller_id in self.v5_controllers:
+                return
+            self.v5_controllers.add(controller_id)
+            legacy = controller_id in self.legacy
+            waiting = self.legacy.pop(controller_id, None)
+        if legacy:
+            logger.debug("Controller '%s' replies using MQTT v5.", controller_id)
+            topic = "foris-controller/%s/reply/+" % controller_id
+            self.topics.remove(topic)
+            self.client.unsubscribe(topic)
+        # replies are received without the legacy subscription
+        for callback in waiting or ():
+            callback()
+
+    def add_notifications(self, topic: str, handler: typing.Callable[[dict, str], None]):
+        """ Subscribes to the notifications (the connection is shared with the replies)
+
+        :param topic: topic filter of the notifications (only "+" wildcards)
+        :param handler: called as handler(notification, controller_id)
+        """
+
+        def on_notification(*args):
+            msg = args[-1]
+            try:
+                parsed = codec.loads(msg.payload)
+            except ValueError:
+                logger.error("Wrong payload not in JSON format")
                 return
+            handler(parsed, msg.topic.split("/")[1])
 
+        self.notifications.add(topic, on_notification)
+        self.subscribe(topic, CONNECT_TIMEOUT)
+
+    def _expire_replies(self):
+        """ Removes a limited amount of expired replies (replies_lock needs to be held)
+        """
+        threshold = time.monotonic() - RETENTION_TIMEOUT
+        for timestamp, key in self.replies_expiry.pop_older(threshold, EXPIRY_BATCH):
+            record = self.replies.get(key)
+            # newer timestamp means that the record was refreshed meanwhile
+            if record and record[0] <= timestamp:
+                del self.replies[key]
+
+    def _process_advertisement(self, controller_id: str, msg: mqtt.MQTTMessage):
+        # recieved a messupdate controller list
+        try:
+            data = codec.loads(msg.payload)
+        except ValueError:
+            logger.error("Advertisement not in JSON format.")
+            return
+        self.registry.update(controller_id, data["data"].get("working_replies", []))
+        logger.debug("Msg for '%s' was processed", msg.topic)
+
+    def _process_response(self, controller_id: str, msg: mqtt.MQTTMessage):
+        correlation_data = getattr(msg.properties, "CorrelationData", None)
+        if not correlation_data:
+            logger.error("Reply without correlation data.")
+            return
+        self._mark_v5(controller_id)
+        self._process_reply(controller_id, correlation_data.decode("utf8"), msg)
+
+    def _process_reply(self, controller_id: str, reply_id: str, msg: mqtt.MQTTMessage):
+        # Find message among replies
+        with self.replies_lock:
+            record: typing.Optinal[
+                typing.Tuple[float, queue.Queue, bool]
+            ] = self.replies.get((controller_id, reply_id))
+
+            # clean older replies
+            self._expire_replies()
+
+            if record:
+                _, output_queue, is_processed = record
+                if is_processed:
+                    # message is already recieved and it is being processed
+                    return
+                else:
+                    # mark that the message is being processed
+                    self.replies[(controller_id, reply_id)][2] = True
+
+            else:
+                logger.debug(
+                    "Message id not found. "
+                    "(probably it is expired or doesn't belong to this client)"
+                )
+                return
+        # Parse and send queue the message
+        try:
+            data = codec.loads(msg.payload)
+        except ValueError:
+            logger.error("Reply not in JSON format.")
+            return
+        logger.debug("Sending response data '%s'", data)
+        output_queue.put(data)
+        logger.debug("Msg for '%s' was processed", msg.topic)
+
+    def on_connect(self, client: mqtt.Client, userdata, flags, rc, properties=None):
+        logger.debug("Client connected.")
+        self.subscribe_topics = list(self.topics)
+        _, self.subscribe_mid = client.subscribe([(topic, 0) for topic in self.subscribe_topics])
+
+    def on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
+        logger.debug("Subscribed to %s.", mid)
+        if mid == self.subscribe_mid:
+            acked = self.subscribe_topics
+            # topics added while the subscriptions were being acknowledged
+            missing = [topic for topic in self.topics if topic not in acked]
+            if missing:
+                self.subscribe_topics = missing
+                _, self.subscribe_mid = client.subscribe([(topic, 0) for topic in missing])
+            self.subscribed.set()
+            with self.legacy_lock:
+                legacy = [
+                    controller_id
+                    for controller_id in self.legacy
+                    if "foris-controller/%s/reply/+" % controller_id in acked
+                ]
+            for controller_id in legacy:
+                self._legacy_acked(controller_id)
+            if self.on_subscribed:
+                self.on_subscribed()
+        else:
+            with self.acks_lock:
+                callback = self.ack_callbacks.pop(mid, None)
+                if callback is None:
+                    self.acks.setdefault(mid, threading.Event()).set()
+            if callback is not None:
+                callback()
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        logger.debug("Disconneted")
+        self.subscribed.clear()
+
+    def on_message(self, client, userdata, msg):
+        logger.debug("Msg recieved for '%s' (msg=%s)", msg.topic, msg.payload)
+        routed = self.router.route(msg.topic, msg)
+        if not self.notifications.route(msg.topic, msg) and not routed:
             # this code should not be reached
             raise ValueError("Topic '%s' doesn't match", msg.topic)
 
-        self.client.on_connect = on_connect
-        self.client.on_subscribe = on_subscribe
-        self.client.on_message = on_message
-        self.client.on_disconnect = on_disconnect
+    def attach(self, client: mqtt.Client):
+        client.on_connect = self.on_connect
+        client.on_subscribe = self.on_subscribe
+        client.on_message = self.on_message
+        client.on_disconnect = self.on_disconnect
+
+    def unsubscribe(self):
+        self.client.unsubscribe(self.topics)
+
+    def run(self):
+        logger.debug("Reply listener is starting.")
+
+        self.attach(self.client)
 
         # start to connect
         self.client.connect(self.host, self.port, CONNECT_TIMEOUT)
@@ -174,203 +583,578 @@ class ReplyListener(threading.Thread):
         self.client.loop_forever()
 
         # try to unsubscribe gracefully
-        self.client.unsubscribe("foris-controller/+/reply/+")
-        self.client.unsubscribe("foris-controller/+/notification/remote/action/advertize")
+        self.unsubscribe()
         self.client.loop()
 
 
+class _Request(object):
+    """ Request which is waiting for its reply
+
+    It is used as the output of send_internal() so the reply listener resolves
+    the future directly. Liveness of the controller is checked by the scheduler
+    when the controller advertises itself or goes offline and periodically as a fallback.
+    """
+
+    def __init__(
+        self,
+        sender: "MqttSender",
+        publish_topic: str,
+        raw_msg: bytes,
+        reply_id: str,
+        controller_id: str,
+        timeout: float,
+    ):
+        self.sender = sender
+        self.publish_topic = publish_topic
+        self.reply_id = reply_id
+        self.controller_id = controller_id
+        # serialized once and reused for the resends
+        self.raw_msg = raw_msg
+        self.max_time: Optional[float] = time.monotonic() + timeout if timeout else None
+        # time of the last (re)send (None => waiting till the replies can be received)
+        self.sent: Optional[float] = None
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+
+    def _set_result(self, result):
+        try:
+            self.future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            pass  # already resolved or cancelled
+
+    def _set_exception(self, exception: Exception):
+        try:
+            self.future.set_exception(exception)
+        except concurrent.futures.InvalidStateError:
+            pass  # already resolved or cancelled
+
+    def put(self, resp: dict):
+        """ Processes the reply (called by the reply listener)
+        """
+        try:
+            self.sender._raise_exception_on_error(resp)
+        except Exception as exc:
+            self._set_exception(exc)
+        else:
+            self._set_result(resp.get("data"))
+
+    def try_send(self):
+        self.sent = time.monotonic()
+        try:
+            self.sender.send_internal(
+                self.publish_topic, self.raw_msg, self.reply_id, self.controller_id, output=self
+            )
+        except ConnectionError:
+            # retry when fosquitto restarts
+            logger.warning("Connection failed, trying to resend '%s'", self.publish_topic)
+            try:
+                self.sender.send_internal(
+                    self.publish_topic, self.raw_msg, self.reply_id, self.controller_id, output=self
+                )
+            except ConnectionError:
+                logger.error("Publishing into '%s' has failed.", self.publish_topic)
+                raise
+
+    def send_subscribed(self):
+        """ Sends the request once its replies can be received (runs in the scheduler)
+        """
+        if self.future.done():
+            return
+        try:
+            self.try_send()
+        except Exception as exc:
+            self._set_exception(exc)
+
+    def schedule_check(self):
+        when = time.monotonic() + ANNOUNCER_PERIOD_REQUIRED
+        if self.max_time is not None:
+            when = min(when, self.max_time)
+        self.sender.scheduler.schedule(when, self.check)
+
+    def check(self, reschedule: bool = True):
+        """ Checks the controller and resends the request when needed (runs in the scheduler)
+
+        :param reschedule: schedule the next periodic check (False for the event-driven checks)
+        """
+        if self.future.done():
+            return
+
+        if self.max_time is not None and time.monotonic() >= self.max_time:
+            self._set_exception(TimeoutError())
+            return
+
+        try:
+            controller = self.sender.registry.get(self.controller_id)
+            working = check_controller(controller, self.controller_id, self.reply_id)
+            # advertisement could have been sent before the request reached the controller
+            if not working and self.sent is not None and time.monotonic() - self.sent >= RESEND_GRACE:
+                logger.warning(
+                    "Message hasn't reached controller trying to resend '%s'", self.publish_topic
+                )
+                self.try_send()
+        except Exception as exc:
+            self._set_exception(exc)
+            return
+
+        if reschedule:
+            self.schedule_check()
+
+
 class MqttSender(BaseSender):
     def __init__(self, *args, **kwargs):
         self.replies: typing.Dict[typing.Tuple[str, str], list] = {}
         self.replies_lock: threading.Lock = threading.Lock()
-        self.controllers: typing.Dict[str, dict] = {}
-        self.controllers_lock: threading.Lock = threading.Lock()
-        self.client_lock: threading.Lock = threading.Lock()
-        self.client_published_event: threading.Event = threading.Event()
+        self.replies_expiry: ExpiryIndex = ExpiryIndex()
+        self.connected: threading.Event = threading.Event()
+        self.reply_subscribed: threading.Event = threading.Event()
         self.client: mqtt.Client
 
         self.mqtt_client_id = f"{uuid.uuid4()}-client-sender"
         self.mqtt_reply_client_id = f"{uuid.uuid4()}-client-reply-watcher"
+        self.response_id = f"{uuid.uuid4()}-client-response"
+        self.scheduler: Scheduler = Scheduler("foris-client-request-scheduler")
+        # controllers which are advertising themselves
+        self.registry: ControllerRegistry = ControllerRegistry(self.scheduler)
+        self.registry.add_callback(self._controller_changed, advertisements=True)
+        # requests waiting for the reply indexed by controller_id
+        self.pending: typing.Dict[str, typing.Set[_Request]] = {}
+        self.pending_lock: threading.Lock = threading.Lock()
+        # set by disconnect(), no new requests are accepted afterwards
+        self.disconnected: bool = False
+        # time.monotonic() of the last subscription of the replies and advertisements
+        self.subscribed_since: Optional[float] = None
         super(MqttSender, self).__init__(*args, **kwargs)
 
     def _prepare_client(self, client_id: str) -> mqtt.Client:
-        client = mqtt.Client(client_id=client_id, clean_session=False, **mqtt_client_extra())
+        return prepare_client(client_id, self.tls_files, self.credentials, self.protocol)
 
-        if self.tls_files:
-            ca_path, cert_path, key_path = self.tls_files
-            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-            context.load_cert_chain(cert_path, key_path)
-            context.load_verify_locations(ca_path)
-            context.verify_mode = ssl.CERT_REQUIRED
-            # can't assume that server cert is issued to particular hostname/ipaddress
-            context.check_hostname = False
-            client.tls_set_context(context)
-
-        if self.credentials:
-            client.username_pw_set(*self.credentials)
-
-        return client
-
-    def connect(self, host, port, default_timeout=None, tls_files=[], credentials=None):
+    def connect(
+        self,
+        host,
+        port,
+        default_timeout=None,
+        tls_files=[],
+        credentials=None,
+        ready_timeout=None,
+        single_connection=False,
+        protocol=mqtt.MQTTv311,
+    ):
+        """ connects to mqtt broker
+
+        :param ready_timeout: wait till the replies can be received (in ms, 0 => wait forever,
+                              None => don't wait)
+        :param single_connection: publish and receive the replies (and the notifications)
+                                  using a single client (a single connection and thread)
+        :param protocol: mqtt.MQTTv311 or mqtt.MQTTv5 (only own replies are received,
+                         using the response topic and correlation data of the requests)
+        :raises TimeoutError: when not ready in time
+        """
         self.default_timeout = _normalize_timeout(default_timeout)
         self.credentials = credentials
         self.tls_files = tls_files
         self.controller_id = None
+        self.single_connection = single_connection
+        self.protocol = protocol
+        self.disconnected = False
 
         # prepare sender client
-        def on_connect(client, userdata, flags, rc):
+        def on_connect(client, userdata, flags, rc, properties=None):
             logger.debug("Client sender connected to mqtt server.")
+            self.connected.set()
+            if self.single_connection:
+                self.reply_worker.on_connect(client, userdata, flags, rc)
+            # requests published while disconnected might have been lost
+            self._check_pending()
 
         def on_publish(client: mqtt.Client, userdata, mid):
-            self.client_published_event.set()
             logger.debug("Client sender published a message (mid=%d).", mid)
 
-        def on_disconnect(client, userdata, rc):
+        def on_disconnect(client, userdata, rc, properties=None):
             logger.debug("Client sender Disconnected.")
+            self.connected.clear()
+            if self.single_connection:
+                self.reply_worker.on_disconnect(client, userdata, rc)
 
         self.client: mqtt.Client = self._prepare_client(self.mqtt_client_id)
-        self.client.on_connect = on_connect
-        self.client.on_publish = on_publish
-        self.client.on_disconnect = on_disconnect
 
         # prepare reply listener client
-        self.reply_client = self._prepare_client(self.mqtt_reply_client_id)
+        if single_connection:
+            self.reply_client = self.client
+        else:
+            self.reply_client = self._prepare_client(self.mqtt_reply_client_id)
         self.reply_worker = ReplyListener(
             replies=self.replies,
             replies_lock=self.replies_lock,
-            controllers=self.controllers,
-            controllers_lock=self.controllers_lock,
+            replies_expiry=self.replies_expiry,
+            registry=self.registry,
             host=host,
             port=port,
             client=self.reply_client,
+            subscribed=self.reply_subscribed,
+            on_subscribed=self._reply_subscribed,
+            response_id=self.response_id if protocol == mqtt.MQTTv5 else None,
         )
-        self.reply_worker.start()
-        logger.debug("Reply worker %s has started.", self.reply_worker)
+        if single_connection:
+            self.reply_worker.attach(self.client)
+        else:
+            self.reply_worker.start()
+            logger.debug("Reply worker %s has started.", self.reply_worker)
+
+        self.client.on_connect = on_connect
+        self.client.on_publish = on_publish
+        self.client.on_disconnect = on_disconnect
+
+        if not self.scheduler.is_alive():
+            self.scheduler.start()
 
         # sender start client thread
         self.client.connect(host, port, CONNECT_TIMEOUT)
         self.client.loop_start()
         logger.debug("Sending thread %s has started.", self.client._thread)
 
+        if ready_timeout is not None and not self.wait_ready(ready_timeout):
+            raise TimeoutError("Not connected to '%s:%d' in time." % (host, port))
+
+    def wait_ready(self, timeout=None, controller_id: Optional[str] = None) -> bool:
+        """ Waits till the sender is connected and the replies can be received
+
+        :param timeout: max time to wait (in ms, None or 0 => wait forever)
+        :param controller_id: wait also till the controller advertises itself
+        :returns: False on timeout
+        """
+        timeout = _normalize_timeout(timeout)
+        deadline = time.monotonic() + timeout if timeout else None
+
+        def remaining():
+            return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+        if not self.connected.wait(remaining()) or not self.reply_subscribed.wait(remaining()):
+            return False
+        if controller_id is None:
+            return True
+
+        advertised = threading.Event()
+
+        def on_change(changed_id, online):
+            if changed_id == controller_id and online:
+                advertised.set()
+
+        self.registry.add_callback(on_change)
+        try:
+            record = self.registry.get(controller_id)
+            return bool(record and record["online"]) or advertised.wait(remaining())
+        finally:
+            self.registry.remove_callback(on_change)
+
+    def advertisement_window_elapsed(self) -> bool:
+        """ Checks whether all the advertising controllers are known
+
+        It takes ANNOUNCER_PERIOD_REQUIRED after the advertisements are subscribed,
+        requests to unknown controllers fail right away afterwards.
+        """
+        subscribed_since = self.subscribed_since
+        return (
+            subscribed_since is not None
+            and time.monotonic() - subscribed_since >= ANNOUNCER_PERIOD_REQUIRED
+        )
+
+    def _reply_subscribed(self):
+        self.subscribed_since = time.monotonic()
+        # replies might have been lost while disconnected
+        self._check_pending()
+
+    def _controller_changed(self, controller_id: str, online: bool):
+        # advertisement or offline transition => pending requests can be decided right now
+        self._check_pending(controller_id)
+
+    def _check_pending(self, controller_id: Optional[str] = None):
+        """ Schedules immediate checks of the pending requests
+
+        :param controller_id: check only the requests of this controller (None => all)
+        """
+        with self.pending_lock:
+            if controller_id is None:
+                requests = [request for group in self.pending.values() for request in group]
+            else:
+                requests = list(self.pending.get(controller_id, ()))
+        now = time.monotonic()
+        for request in requests:
+            self.scheduler.schedule(now, functools.partial(request.check, reschedule=False))
+
+    def _add_pending(self, request: _Request):
+        """ Registers the request as pending
+
+        :raises ConnectionError: when the sender has been disconnected
+        """
+        with self.pending_lock:
+            if self.disconnected:
+                raise ConnectionError("Sender is disconnected.")
+            self.pending.setdefault(request.controller_id, set()).add(request)
+
+        def remove(future):
+            with self.pending_lock:
+                requests = self.pending.get(request.controller_id)
+                if requests is not None:
+                    requests.discard(request)
+                    if not requests:
+                        del self.pending[request.controller_id]
+
+        request.future.add_done_callback(remove)
+
+    def listen_notifications(
+        self,
+        handler: typing.Callable[[dict, str], None],
+        module: Optional[str] = None,
+        controller_id: str = "+",
+    ):
+        """ Passes the notifications to the handler (using the connection of the replies)
+
+        Handler is called as handler(notification, controller_id) from the network thread
+        so it should not block. Only one handler per module and controller_id is kept.
+
+        :param module: listen only to the notifications of the module (None => all modules)
+        :param controller_id: listen only to the notifications of the controller ("+" => all)
+        """
+        topic = "foris-controller/%s/notification/%s/action/+" % (
+            controller_id if controller_id else "+",
+            module if module else "+",
+        )
+        self.reply_worker.add_notifications(topic, handler)
+
     def disconnect(self):
-        self.client.disconnect()
-        logger.debug("Sender Disconnected.")
-        self.reply_client.disconnect()
-        logger.debug("Reply client Disconnected.")
+        # the pending requests would never be resolved (their checks are run by the scheduler)
+        with self.pending_lock:
+            self.disconnected = True
+            requests = [request for group in self.pending.values() for request in group]
+        for request in requests:
+            request._set_exception(ConnectionError("Sender has been disconnected."))
+
+        if self.single_connection:
+            # try to unsubscribe gracefully
+            self.reply_worker.unsubscribe()
+            self.client.disconnect()
+            logger.debug("Sender Disconnected.")
+        else:
+            self.client.disconnect()
+            logger.debug("Sender Disconnected.")
+            self.reply_client.disconnect()
+            logger.debug("Reply client Disconnected.")
+        self.scheduler.stop()
+
+    def _publish(
+        self, msg_topic: str, raw_data: bytes, timeout: float, properties: Optional[Properties] = None
+    ) -> bool:
+        """ Publishes the message and waits till it is passed to the broker
+
+        Each message is tracked using its own message info so that parallel publishers
+        don't need to wait for each other (and nothing is left behind when it times out).
+        """
+        info = self.client.publish(msg_topic, raw_data, qos=0, properties=properties)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+
+        try:
+            info.wait_for_publish(timeout)
+        except (ValueError, RuntimeError):
+            return False
+        return info.is_published()
 
     def send_internal(
-        self, msg_topic: str, msg_data: dict, reply_id: str, controller_id: str
+        self,
+        msg_topic: str,
+        msg_data: typing.Union[dict, str, bytes],
+        reply_id: str,
+        controller_id: str,
+        output: Optional[typing.Any] = None,
     ) -> queue.Queue:
         """ Sends the message without waiting for the response
+
+        :param msg_data: message or already serialized message (reused when resending)
+        :param output: queue-like object (with put() method) which obtains the reply
+                       (new queue.Queue is created by default)
         """
 
-        output: queue.Queue
-        # only one message can be send at once
-        with self.client_lock:
-            logger.debug("Sending message for '%s'.", msg_topic)
-
-            # preapre queue for the listener
-            with self.replies_lock:
-                if (controller_id, reply_id) in self.replies:
-                    # already waiting for reply -> just update the time
-                    logger.debug("Reusing reply_id %s", reply_id)
-                    self.replies[(controller_id, reply_id)][0] = time.monotonic()
-                    output = self.replies[(controller_id, reply_id)][1]
-                else:
-                    # create new queue to wait
-                    logger.debug("Using new reply_id '%s", reply_id)
-                    output = queue.Queue(maxsize=1)
-                    self.replies[(controller_id, reply_id)] = [time.monotonic(), output, False]
+        logger.debug("Sending message for '%s'.", msg_topic)
+
+        # preapre queue for the listener
+        with self.replies_lock:
+            now = time.monotonic()
+            if (controller_id, reply_id) in self.replies:
+                # already waiting for reply -> just update the time
+                logger.debug("Reusing reply_id %s", reply_id)
+                self.replies[(controller_id, reply_id)][0] = now
+                output = self.replies[(controller_id, reply_id)][1]
+            else:
+                # create new queue to wait
+                logger.debug("Using new reply_id '%s", reply_id)
+                output = queue.Queue(maxsize=1) if output is None else output
+                self.replies[(controller_id, reply_id)] = [now, output, False]
+            self.replies_expiry.push(now, (controller_id, reply_id))
 
-            # clear published event
-            self.client_published_event.clear()
+        # start to perform
+        raw_data = msg_data if isinstance(msg_data, (str, bytes)) else codec.dumps(msg_data)
 
-            # start to perform
-            raw_data = json.dumps(msg_data)
-            self.client.publish(msg_topic, raw_data, qos=0)
+        properties = None
+        if self.protocol == mqtt.MQTTv5:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ResponseTopic = self.reply_worker.response_topic(controller_id)
+            properties.CorrelationData = reply_id.encode("utf8")
 
-            logger.debug("Sending msg for '%s'", msg_topic)
+        logger.debug("Sending msg for '%s'", msg_topic)
 
-            if not self.client_published_event.wait(0.3):
-                logger.debug("Failed to publish the message for '%s'. (retry)", msg_topic)
-                if not self.client.publish(msg_topic, raw_data, qos=0):
-                    logger.debug("Failed to publish the message for '%s'. (exception)", msg_topic)
-                    # Msg can't reache thte controller
-                    raise ControllerMissing(controller_id)
+        if not self._publish(msg_topic, raw_data, PUBLISH_TIMEOUT, properties):
+            logger.debug("Failed to publish the message for '%s'. (retry)", msg_topic)
+            self.client.publish(msg_topic, raw_data, qos=0, properties=properties)
 
-            logger.debug("Message for '%s' was sent", msg_topic)
+        logger.debug("Message for '%s' was sent", msg_topic)
 
         return output
 
-    def send(
+    def send_async(
         self, module: str, action: str, data: dict, timeout=None, controller_id: str = None
-    ) -> dict:
-        """ Sends the message and waits for the response
-        :param timeout: wait for X seconds for reply (0 => wait forever)
+    ) -> concurrent.futures.Future:
+        """ Sends the message, the future is resolved when the response arrives
+        :param timeout: wait for X miliseconds for reply (0 => wait forever)
+        """
+        reply_id = str(uuid.uuid4())
+        msg = {"reply_msg_id": reply_id}
+        if data is not None:
+            msg["data"] = data
+        return self._send_request(module, action, codec.dumps(msg), reply_id, timeout, controller_id)
+
+    def _send_request(
+        self,
+        module: str,
+        action: str,
+        raw_msg: bytes,
+        reply_id: str,
+        timeout: Optional[int],
+        controller_id: Optional[str],
+        ready_deadline: Optional[float] = None,
+    ) -> concurrent.futures.Future:
+        """ Sends the request, the future is resolved when the reply arrives
+
+        :param ready_deadline: time.monotonic() till which it can be waited for the sender
+                               to be ready (now + CONNECT_TIMEOUT by default), it is bounded
+                               by the timeout of the request as well
         """
         controller_id = prepare_controller_id(controller_id)
 
         timeout = self.default_timeout if timeout is None else _normalize_timeout(timeout)
-        reply_id = str(uuid.uuid4())
         publish_topic: Optional[str] = "foris-controller/%s/request/%s/action/%s" % (
             controller_id,
             module,
             action,
         )
 
-        msg = {"reply_msg_id": reply_id}
-        if data is not None:
-            msg["data"] = data
-
-        output: queue.Queue
-
-        def try_send() -> queue.Queue:
-            try:
-                return self.send_internal(publish_topic, msg, reply_id, controller_id)
-            except ConnectionError:
-                # retry when fosquitto restarts
-                logger.warning("Connection failed, trying to resend '%s'", publish_topic)
-                try:
-                    return self.send_internal(publish_topic, msg, reply_id, controller_id)
-                except ConnectionError:
-                    logger.error("Publishing into '%s' has failed.", publish_topic)
-                    raise
-
-        def check_controllers() -> bool:
-            with self.controllers_lock:
-                controller = self.controllers.get(controller_id)
-                if not controller:
-                    # controller hasn't appear yet
-                    raise ControllerMissing(controller_id)
-                if controller["last"] < time.monotonic() - ANNOUNCER_PERIOD_REQUIRED:
-                    # controller is not alive
-                    raise ControllerMissing(controller_id)
-                if reply_id not in controller["working_replies"]:
-                    # message is not being processed by the controller
-                    logger.warning(
-                        "Message hasn't reached controller trying to resend '%s'", publish_topic
-                    )
-                    return False
-                # otherwise controller is performing some long lasting task and hasn't replied yet
-                return True
+        if self.disconnected:
+            future: concurrent.futures.Future = concurrent.futures.Future()
+            future.set_exception(ConnectionError("Sender is disconnected."))
+            return future
+
+        request = _Request(self, publish_topic, raw_msg, reply_id, controller_id, timeout)
+
+        if not self.reply_subscribed.is_set():
+            # reply would be lost otherwise
+            if ready_deadline is None:
+                ready_deadline = time.monotonic() + CONNECT_TIMEOUT
+            if request.max_time is not None:
+                ready_deadline = min(ready_deadline, request.max_time)
+            wait = ready_deadline - time.monotonic()
+            if wait <= 0 or not self.wait_ready(wait * 1000):
+                if request.max_time is not None and time.monotonic() >= request.max_time:
+                    request.future.set_exception(TimeoutError())
+                else:
+                    request.future.set_exception(ConnectionError("Sender is not connected."))
+                return request.future
 
-        output = try_send()
+        if self.advertisement_window_elapsed() and self.registry.get(controller_id) is None:
+            # all the advertising controllers are known => fail fast
+            request.future.set_exception(ControllerMissing(controller_id))
+            return request.future
 
-        def process_resp(resp: dict):
-            self._raise_exception_on_error(resp)
-            return resp.get("data")
+        try:
+            self._add_pending(request)
+        except ConnectionError as exc:
+            request.future.set_exception(exc)
+            return request.future
 
-        max_time: float = time.monotonic() + timeout
+        if self.protocol == mqtt.MQTTv5 and not self.reply_worker.ensure_legacy(
+            controller_id,
+            lambda: self.scheduler.schedule(time.monotonic(), request.send_subscribed),
+        ):
+            # controller might not support MQTT v5, so the request is sent when the legacy
+            # subscription is acknowledged (its timeout is handled by the checks meanwhile)
+            request.schedule_check()
+            return request.future
+
+        try:
+            request.try_send()
+        except Exception as exc:
+            request.future.set_exception(exc)
+            return request.future
+
+        # right now we are waiting for the response, controller is checked on its advertisements
+        # and periodically as a fallback
+        request.schedule_check()
+        return request.future
 
-        # right now we are passed first ANNOUNCER_PERIOD_REQUIRED and waiting for the response
-        while timeout == 0.0 or time.monotonic() <= max_time:
-            try:
-                return process_resp(output.get(timeout=ANNOUNCER_PERIOD_REQUIRED))
-            except queue.Empty:
-                if not check_controllers():
-                    output = try_send()
+    def send(
+        self, module: str, action: str, data: dict, timeout=None, controller_id: str = None
+    ) -> dict:
+        """ Sends the message and waits for the response
+        :param timeout: wait for X miliseconds for reply (0 => wait forever)
+        """
+        return self.send_async(module, action, data, timeout, controller_id).result()
 
-        raise TimeoutError()
+    def send_many(
+        self,
+        module: str,
+        action: str,
+        data: dict,
+        controller_ids: typing.Iterable[str],
+        concurrency: int = 64,
+        timeout=None,
+    ) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+        """ Sends the same request to many controllers and yields the replies as they arrive
+
+        The failures (e.g. ControllerMissing, ControllerError, TimeoutError) are yielded
+        instead of the reply, so a single failing controller doesn't stop the others.
+
+        :param controller_ids: controllers where the request will be sent
+        :param concurrency: max number of requests waiting for the reply at the same time
+        :param timeout: wait for X miliseconds for each reply (0 => wait forever)
+        :returns: iterator of (controller_id, reply or exception)
+        """
+        # data are serialized only once
+        raw_data = b"" if data is None else b',"data":' + codec.dumps(data)
+        # the requests don't wait for the sender to be ready one after another
+        wait = self.default_timeout if timeout is None else _normalize_timeout(timeout)
+        ready_deadline = time.monotonic() + (wait if wait else CONNECT_TIMEOUT)
+        controller_ids = iter(controller_ids)
+        pending: typing.Dict[concurrent.futures.Future, str] = {}
+
+        def fill():
+            while len(pending) < concurrency:
+                controller_id = next(controller_ids, _END)
+                if controller_id is _END:
+                    return
+                reply_id = str(uuid.uuid4())
+                raw_msg = b'{"reply_msg_id":"' + reply_id.encode() + b'"' + raw_data + b"}"
+                future = self._send_request(
+                    module, action, raw_msg, reply_id, timeout, controller_id, ready_deadline
+                )
+                pending[future] = controller_id
+
+        fill()
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                controller_id = pending.pop(future)
+                exception = future.exception()
+                yield controller_id, exception if exception else future.result()
+            fill()
 
     def __del__(self):
         """ Close all connections -> worker thread should eventually terminate"""
@@ -392,10 +1176,39 @@ class MqttListener(BaseListener):
         tls_files=[],
         controller_id="+",
         credentials=None,
+        group=None,
+        shard=None,
+        workers=0,
+        queue_size=0,
+        overflow=OVERFLOW_BLOCK,
     ):
+        """ connects to mqtt broker
+
+        :param group: share the notifications among the listeners of the group
+                      (MQTT shared subscription, the order of the notifications is not kept)
+        :param shard: (index, count) process only the notifications of the controllers
+                      within the shard (each listener still receives all the notifications,
+                      but the order of the notifications of a controller is kept)
+        :param workers: number of threads which parse the notifications and call the handler
+                        (notifications of a controller are handled in order,
+                        0 => handle them within the network thread)
+        :param queue_size: max number of queued notifications (0 => unlimited)
+        :param overflow: what to do when the queue is full - block the network thread
+                         (OVERFLOW_BLOCK) or drop a notification (OVERFLOW_DROP_OLDEST,
+                         OVERFLOW_DROP_NEWEST)
+        """
+        if group and shard:
+            raise ValueError("group and shard can't be used together")
+        if shard and not 0 <= shard[0] < shard[1]:
+            raise ValueError("Invalid shard %d/%d" % shard)
         self.controller_id = controller_id
         self.tls_files = tls_files
         self.credentials = credentials
+        self.dispatcher: Optional[OrderedDispatcher] = None
+        if workers:
+            self.dispatcher = OrderedDispatcher(
+                workers, "foris-client-listener", queue_size, overflow
+            )
 
         def on_disconnect(client, userdata, rc):
             logger.debug("Listener Disconnected.")
@@ -406,6 +1219,8 @@ class MqttListener(BaseListener):
                 self.controller_id if self.controller_id else "+",
                 module if module else "+",
             )
+            if group:
+                listen_topic = "$share/%s/%s" % (group, listen_topic)
             rc, mid = client.subscribe(listen_topic, qos=0)
             if rc != 0:
                 logger.error("Failed to subscribe to '%s'", listen_topic)
@@ -415,17 +1230,30 @@ class MqttListener(BaseListener):
         def on_subscribe(client, userdata, mid, granted_qos):
             logger.debug("Subscribed (mid=%d)", mid)
 
-        def on_message(client, userdata, msg):
-            logger.debug("Notification recieved (topic=%s, payload=%s)", msg.topic, msg.payload)
+        def handle(controller_id, msg):
             try:
-                parsed = json.loads(msg.payload)
+                parsed = codec.loads(msg.payload)
             except Exception:
                 logger.error("Wrong payload not in JSON format")
-            controller_id, _, _ = re.match(
-                "foris-controller/([^/]+)/notification/([^/]+)/action/([^/]+)$", msg.topic
-            ).groups()
+                return
             handler(parsed, controller_id)
 
+        def on_notification(controller_id, module, action, msg):
+            if shard and controller_shard(controller_id, shard[1]) != shard[0]:
+                return
+            if self.dispatcher:
+                if not self.dispatcher.submit(controller_id, lambda: handle(controller_id, msg)):
+                    logger.debug("Notification queue is full, notification was dropped.")
+            else:
+                handle(controller_id, msg)
+
+        router = TopicRouter()
+        router.add("foris-controller/+/notification/+/action/+", on_notification)
+
+        def on_message(client, userdata, msg):
+            logger.debug("Notification recieved (topic=%s, payload=%s)", msg.topic, msg.payload)
+            router.route(msg.topic, msg)
+
         self.client = mqtt.Client(client_id=self.mqtt_client_id, clean_session=False, **mqtt_client_extra())
 
         if self.tls_files:
@@ -451,6 +1279,15 @@ class MqttListener(BaseListener):
     def disconnect(self):
         logger.debug("Closing connection.")
         self.client.disconnect()
+        if self.dispatcher:
+            self.dispatcher.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        """ Returns the number of queued ("depth") and dropped ("dropped") notifications
+        """
+        if not self.dispatcher:
+            return {"depth": 0, "dropped": 0}
+        return {"depth": self.dispatcher.depth, "dropped": self.dispatcher.dropped}
 
     def listen(self):
         logger.debug("Starting to listen.")
@@ -461,3 +1298,239 @@ class MqttListener(BaseListener):
         else:
             self.client.loop_forever()
         logger.debug("Listening stopped")
+
+
+class AsyncioLoopAdapter(object):
+    """ Performs network operations of a paho client within asyncio event loop
+
+    Socket reads and writes are triggered by the event loop so no extra thread is required.
+    """
+
+    MISC_PERIOD = 1.0  # in seconds
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: mqtt.Client):
+        self.loop = loop
+        self.client = client
+        self.stopped = False
+        self.misc_task: Optional[asyncio.Task] = None
+
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        if not self.misc_task:
+            self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        while not self.stopped:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN and not self.stopped:
+                # paho doesn't reconnect automatically when its loop is not used
+                try:
+                    self.client.reconnect()
+                except OSError as exc:
+                    logger.debug("Failed to reconnect (%s).", exc)
+            await asyncio.sleep(self.MISC_PERIOD)
+
+    def stop(self):
+        self.stopped = True
+        if self.misc_task:
+            self.misc_task.cancel()
+
+
+class AsyncMqttSender(AsyncBaseSender):
+    async def connect(self, host, port, default_timeout=None, tls_files=[], credentials=None):
+        """ connects to mqtt broker and waits till the replies can be received
+
+        Publishing and reply processing share a single client which is driven
+        by the running event loop.
+        """
+        self.default_timeout = _normalize_timeout(default_timeout)
+        self.replies: typing.Dict[typing.Tuple[str, str], asyncio.Future] = {}
+        self.controllers: typing.Dict[str, dict] = {}
+        self.subscribed = asyncio.Event()
+        self.subscribe_mid: Optional[int] = None
+        self.mqtt_client_id = f"{uuid.uuid4()}-client-async-sender"
+
+        def on_connect(client, userdata, flags, rc):
+            logger.debug("Client connected.")
+            _, self.subscribe_mid = client.subscribe(
+                [
+                    ("foris-controller/+/reply/+", 0),
+                    ("foris-controller/+/notification/remote/action/advertize", 0),
+                ]
+            )
+
+        def on_subscribe(client, userdata, mid, granted_qos):
+            logger.debug("Subscribed to %s.", mid)
+            if mid == self.subscribe_mid:
+                self.subscribed.set()
+
+        def on_disconnect(client, userdata, rc):
+            logger.debug("Disconneted")
+            self.subscribed.clear()
+
+        def on_advertisement(controller_id, msg):
+            try:
+                data = codec.loads(msg.payload)
+            except ValueError:
+                logger.error("Advertisement not in JSON format.")
+                return
+            self.controllers[controller_id] = {
+                "last": time.monotonic(),
+                "working_replies": data["data"].get("working_replies", []),
+            }
+
+        def on_reply(controller_id, reply_id, msg):
+            future = self.replies.get((controller_id, reply_id))
+            if not future or future.done():
+                logger.debug(
+                    "Message id not found. "
+                    "(probably it is expired or doesn't belong to this client)"
+                )
+                return
+            try:
+                future.set_result(codec.loads(msg.payload))
+            except ValueError:
+                logger.error("Reply not in JSON format.")
+
+        router = TopicRouter()
+        router.add("foris-controller/+/notification/remote/action/advertize", on_advertisement)
+        router.add("foris-controller/+/reply/+", on_reply)
+
+        def on_message(client, userdata, msg):
+            logger.debug("Msg recieved for '%s' (msg=%s)", msg.topic, msg.payload)
+            if not router.route(msg.topic, msg):
+                # this code should not be reached
+                raise ValueError("Topic '%s' doesn't match", msg.topic)
+
+        self.client = prepare_client(self.mqtt_client_id, tls_files, credentials)
+        self.client.on_connect = on_connect
+        self.client.on_subscribe = on_subscribe
+        self.client.on_disconnect = on_disconnect
+        self.client.on_message = on_message
+        self.adapter = AsyncioLoopAdapter(asyncio.get_running_loop(), self.client)
+
+        self.client.connect(host, port, CONNECT_TIMEOUT)
+        await asyncio.wait_for(self.subscribed.wait(), CONNECT_TIMEOUT)
+        logger.debug("Connected to '%s:%d'.", host, port)
+
+    async def send(
+        self, module: str, action: str, data: dict, timeout=None, controller_id: str = None
+    ) -> dict:
+        """ Sends the message and waits for the response
+        :param timeout: wait for X miliseconds for reply (0 => wait forever)
+        """
+        controller_id = prepare_controller_id(controller_id)
+
+        timeout = self.default_timeout if timeout is None else _normalize_timeout(timeout)
+        reply_id = str(uuid.uuid4())
+        publish_topic = "foris-controller/%s/request/%s/action/%s" % (
+            controller_id,
+            module,
+            action,
+        )
+
+        msg = {"reply_msg_id": reply_id}
+        if data is not None:
+            msg["data"] = data
+        raw_data = codec.dumps(msg)
+
+        future = asyncio.get_running_loop().create_future()
+        self.replies[(controller_id, reply_id)] = future
+        try:
+            logger.debug("Sending msg for '%s'", publish_topic)
+            self.client.publish(publish_topic, raw_data, qos=0)
+
+            max_time: float = time.monotonic() + timeout
+            while timeout == 0.0 or time.monotonic() <= max_time:
+                try:
+                    resp = await asyncio.wait_for(
+                        asyncio.shield(future), ANNOUNCER_PERIOD_REQUIRED
+                    )
+                except asyncio.TimeoutError:
+                    controller = self.controllers.get(controller_id)
+                    if not check_controller(controller, controller_id, reply_id):
+                        logger.warning(
+                            "Message hasn't reached controller trying to resend '%s'",
+                            publish_topic,
+                        )
+                        self.client.publish(publish_topic, raw_data, qos=0)
+                else:
+                    self._raise_exception_on_error(resp)
+                    return resp.get("data")
+        finally:
+            del self.replies[(controller_id, reply_id)]
+
+        raise TimeoutError()
+
+    async def disconnect(self):
+        self.adapter.stop()
+        self.client.disconnect()
+        logger.debug("Sender Disconnected.")
+
+
+class AsyncMqttListener(AsyncBaseListener):
+    async def connect(
+        self,
+        host,
+        port,
+        module=None,
+        tls_files=[],
+        controller_id="+",
+        credentials=None,
+    ):
+        """ connects to mqtt broker and subscribes to notifications
+
+        Network operations of the client are performed by the running event loop.
+        """
+        self.controller_id = controller_id
+        self.mqtt_client_id = f"{uuid.uuid4()}-client-async-listener"
+        listen_topic = "foris-controller/%s/notification/%s/action/+" % (
+            controller_id if controller_id else "+",
+            module if module else "+",
+        )
+
+        def on_connect(client, userdata, flags, rc):
+            rc, mid = client.subscribe(listen_topic, qos=0)
+            if rc != 0:
+                logger.error("Failed to subscribe to '%s'", listen_topic)
+            logger.debug("Subscribing to '%s' (mid=%d)", listen_topic, mid)
+
+        def on_notification(controller_id, module, action, msg):
+            try:
+                parsed = codec.loads(msg.payload)
+            except ValueError:
+                logger.error("Wrong payload not in JSON format")
+                return
+            self._notify(parsed, controller_id)
+
+        router = TopicRouter()
+        router.add("foris-controller/+/notification/+/action/+", on_notification)
+
+        def on_message(client, userdata, msg):
+            logger.debug("Notification recieved (topic=%s, payload=%s)", msg.topic, msg.payload)
+            router.route(msg.topic, msg)
+
+        self.client = prepare_client(self.mqtt_client_id, tls_files, credentials)
+        self.client.on_connect = on_connect
+        self.client.on_message = on_message
+        self.adapter = AsyncioLoopAdapter(asyncio.get_running_loop(), self.client)
+        self.client.connect(host, port, CONNECT_TIMEOUT)
+
+    async def disconnect(self):
+        logger.debug("Closing connection.")
+        self.adapter.stop()
+        self.client.disconnect()
+        self._stop_notifications()
@@ -19,32 +19,491 @@
 
 from __future__ import absolute_import
 
+import asyncio
+import codecs
+import concurrent.futures
+import fnmatch
+import functools
+import itertools
 import logging
+import math
+import os
+import queue
+import re
+import select
+import socket
+import stat
+import threading
+import time
+import typing
 import ubus
 import uuid
-import json
 
-from .base import BaseSender, BaseListener, prepare_controller_id
+from .. import codec
+from .base import (
+    AsyncBaseListener,
+    AsyncBaseSender,
+    BaseListener,
+    BaseSender,
+    prepare_controller_id,
+)
 
 logger = logging.getLogger(__name__)
 
+LOOP_SLICE = 100  # in ms (used only when the ubus socket can't be found)
+CHUNK_SIZE = 512 * 1024  # in characters
+TASK_BATCH = 16  # tasks processed between the event processing
+OBJECT_PREFIX = "foris-controller-"
+FLUSH_DELAY = 2  # in ms, idle time after calls before the events queued in libubus are processed
 
-def _chunks(data, size):
-    for i in range(0, len(data), size):
-        yield data[i : i + size]
+
+def _iterstream(
+    stream: typing.Union[typing.IO, typing.Iterable[typing.Union[str, bytes]]], size: int
+) -> typing.Iterator[str]:
+    """ Reads str pieces from a file-like object or an iterable of str/bytes (utf8 encoded)
+    """
+    if hasattr(stream, "read"):
+        stream = iter(functools.partial(stream.read, size), stream.read(0))
+
+    decoder = codecs.getincrementaldecoder("utf8")()
+    for piece in stream:
+        if not isinstance(piece, str):
+            piece = decoder.decode(piece)
+        if piece:
+            yield piece
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def _remaining_timeout(deadline):
+    """ Returns the remaining time till deadline in ms (0 => no deadline)
+
+    :raises TimeoutError: when the deadline was reached
+    """
+    if deadline is None:
+        return 0
+    remaining = math.ceil((deadline - time.monotonic()) * 1000)
+    if remaining <= 0:
+        raise TimeoutError()
+    return remaining
+
+
+def _call(ubus_object, action, arguments, deadline):
+    """ ubus.call which is limited by the deadline (in time.monotonic())
+
+    :raises TimeoutError: when the deadline was reached
+    """
+    try:
+        return ubus.call(ubus_object, action, arguments, timeout=_remaining_timeout(deadline))
+    except RuntimeError as exc:
+        # the binding reports timeouts as generic RuntimeError
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError() from exc
+        raise
+
+
+def _find_ubus_fd(socket_path: str) -> typing.Optional[int]:
+    """ Finds the file descriptor of the ubus connection (the binding doesn't expose it)
+
+    :returns: fd of the socket connected to socket_path or None if it can't be found
+    """
+    try:
+        fds = [int(e) for e in os.listdir("/proc/self/fd")]
+    except OSError:
+        return None
+
+    found = []
+    for fd in fds:
+        try:
+            if not stat.S_ISSOCK(os.fstat(fd).st_mode):
+                continue
+            sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)  # dups the fd
+            try:
+                peer = sock.getpeername()
+            finally:
+                sock.close()
+        except OSError:
+            continue
+        if isinstance(peer, str) and peer and os.path.realpath(peer) == os.path.realpath(socket_path):
+            found.append(fd)
+
+    # be conservative when it is ambiguous
+    return found[0] if len(found) == 1 else None
+
+
+class UbusDispatcher(threading.Thread):
+    """ Thread which owns the process-global ubus connection
+
+    The binding is neither thread-safe nor reentrant, so all ubus operations are
+    queued and performed here one by one and their results are passed via futures.
+    Incoming events are processed between the operations while there are subscriptions.
+
+    The thread sleeps in select() on the ubus socket and on a wakeup socket
+    which is written when a new operation is queued, so it doesn't wake up when idle.
+    """
+
+    def __init__(self):
+        super().__init__(name="foris-client-ubus", daemon=True)
+        self._tasks: queue.SimpleQueue = queue.SimpleQueue()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        # duplicate of the ubus connection socket (used only to wait for the events)
+        self._ubus_sock: typing.Optional[socket.socket] = None
+        # subscription handle -> (patterns, handler)
+        self._subscriptions: typing.Dict[
+            int, typing.Tuple[typing.List[str], typing.Callable[[str, dict], None]]
+        ] = {}
+        # patterns which are already registered in the binding (it can't unregister them)
+        self._registered: typing.Set[str] = set()
+        self._handles = itertools.count()
+        # names of registered foris-controller objects (None => not known)
+        self._objects: typing.Optional[typing.Set[str]] = None
+        self._objects_subscription: typing.Optional[int] = None
+
+    def submit(self, fn: typing.Callable, *args, **kwargs) -> concurrent.futures.Future:
+        """ performs fn(*args, **kwargs) in the ubus thread
+
+        :returns: future of the result
+        """
+        future = concurrent.futures.Future()
+        if threading.current_thread() is self:
+            # called from a task or from an event handler
+            self._run(fn, args, kwargs, future)
+        else:
+            self._tasks.put((fn, args, kwargs, future))
+            self._wakeup()
+        return future
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except BlockingIOError:
+            pass  # already full of wakeups
+
+    def call(
+        self, ubus_object: str, method: str, arguments: dict, deadline: typing.Optional[float] = None
+    ) -> concurrent.futures.Future:
+        """ calls a method of an ubus object
+
+        :param deadline: the call fails with TimeoutError after this time (in time.monotonic())
+        :returns: future of the result
+        """
+        return self.submit(_call, ubus_object, method, arguments, deadline)
+
+    def connect(self, socket_path: str) -> concurrent.futures.Future:
+        return self.submit(self._connect, socket_path)
+
+    def ensure_connected(self, socket_path: str) -> concurrent.futures.Future:
+        """ connects to ubus unless it is already connected
+
+        :returns: future of bool whether it was connected before
+        """
+        return self.submit(self._ensure_connected, socket_path)
+
+    def disconnect(self) -> concurrent.futures.Future:
+        return self.submit(self._disconnect)
+
+    def subscribe(
+        self, patterns: typing.List[str], handler: typing.Callable[[str, dict], None]
+    ) -> concurrent.futures.Future:
+        """ starts to listen to events
+
+        The handler is called in the ubus thread, so it should not block.
+
+        :param patterns: ubus event patterns (e.g. "foris-controller-*")
+        :param handler: called with event name and its data
+        :returns: future of the subscription handle
+        """
+        return self.submit(self._subscribe, list(patterns), handler)
+
+    def unsubscribe(self, handle: int) -> concurrent.futures.Future:
+        return self.submit(self._subscriptions.pop, handle, None)
+
+    def watch_objects(self) -> concurrent.futures.Future:
+        """ starts to maintain an index of registered foris-controller objects
+
+        The index is filled using ubus.objects() and then it is updated
+        by ubus.object.add and ubus.object.remove events.
+        """
+        return self.submit(self._watch_objects)
+
+    def objects(self) -> typing.Optional[typing.FrozenSet[str]]:
+        """ returns the registered foris-controller objects (None => not known)
+
+        It reads the index directly, so it doesn't wait for the ubus thread.
+        """
+        objects = self._objects
+        return None if objects is None else frozenset(objects)
+
+    def has_object(self, name: str) -> typing.Optional[bool]:
+        """ whether the object is registered (None => not known)
+
+        It reads the index directly, so it doesn't wait for the ubus thread.
+        """
+        objects = self._objects
+        return None if objects is None else name in objects
+
+    def lookup_object(self, name: str) -> concurrent.futures.Future:
+        """ looks the object up in ubus directly (the index might not be updated yet)
+
+        The object is added to the index when it is found.
+
+        :returns: future of whether the object is registered
+        """
+        return self.submit(self._lookup_object, name)
+
+    def _run(self, fn, args, kwargs, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    def _connect(self, socket_path):
+        ubus.connect(socket_path)
+        self._close_ubus_sock()
+        fd = _find_ubus_fd(ubus.get_socket_path())
+        if fd is None:
+            logger.warning("Ubus socket not found, falling back to polling.")
+        else:
+            self._ubus_sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+            self._ubus_sock.setblocking(False)
+        self._registered.clear()
+        self._register()
+        if self._objects_subscription is not None:
+            self._list_objects()
+
+    def _ensure_connected(self, socket_path):
+        if ubus.get_connected():
+            return True
+        logger.debug("Connecting to ubus (%s)." % socket_path)
+        self._connect(socket_path)
+        return False
+
+    def _disconnect(self):
+        ubus.disconnect()
+        self._close_ubus_sock()
+        self._registered.clear()
+        self._objects = None
+
+    def _close_ubus_sock(self):
+        if self._ubus_sock is not None:
+            self._ubus_sock.close()
+            self._ubus_sock = None
+
+    def _ubus_sock_closed(self) -> bool:
+        try:
+            return self._ubus_sock.recv(1, socket.MSG_PEEK) == b""
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    def _watch_objects(self):
+        if self._objects_subscription is None:
+            # subscribe first so that no change is missed
+            self._objects_subscription = self._subscribe(
+                ["ubus.object.add", "ubus.object.remove"], self._object_event
+            )
+        if self._objects is None:
+            self._list_objects()
+
+    def _lookup_object(self, name: str) -> bool:
+        if not ubus.get_connected():
+            return False
+        try:
+            found = name in ubus.objects(name)
+        except RuntimeError:
+            found = False  # not found
+        if found and self._objects is not None:
+            # the ubus.object.add event hasn't been processed yet
+            self._objects.add(name)
+        return found
+
+    def _list_objects(self):
+        if ubus.get_connected():
+            self._objects = set(ubus.objects(OBJECT_PREFIX + "*"))
+            logger.debug("%d foris-controller objects registered." % len(self._objects))
+        else:
+            self._objects = None
+
+    def _object_event(self, event, data):
+        path = data.get("path", "")
+        if self._objects is None or not path.startswith(OBJECT_PREFIX):
+            return
+        if event == "ubus.object.add":
+            logger.debug("Object '%s' was added." % path)
+            self._objects.add(path)
+        else:
+            logger.debug("Object '%s' was removed." % path)
+            self._objects.discard(path)
+
+    def _subscribe(self, patterns, handler):
+        handle = next(self._handles)
+        self._subscriptions[handle] = (patterns, handler)
+        self._register()
+        return handle
+
+    def _register(self):
+        if not ubus.get_connected():
+            return  # registered after connect
+        for patterns, _ in list(self._subscriptions.values()):
+            for pattern in patterns:
+                if pattern not in self._registered:
+                    ubus.listen((pattern, functools.partial(self._dispatch, pattern)))
+                    self._registered.add(pattern)
+
+    def _dispatch(self, pattern, event, data):
+        for patterns, handler in list(self._subscriptions.values()):
+            if pattern in patterns:
+                try:
+                    handler(event, data)
+                except Exception:
+                    logger.exception("Ubus event handler %r has failed.", handler)
+
+    def run(self):
+        flush = False
+        while True:
+            # perform queued operations (but don't let them starve the events)
+            performed = 0
+            while performed < TASK_BATCH:
+                try:
+                    task = self._tasks.get_nowait()
+                except queue.Empty:
+                    break
+                self._run(*task)
+                performed += 1
+
+            listening = bool(self._subscriptions) and ubus.get_connected()
+            # events which arrived during the calls are queued within libubus
+            # and they are processed only from its loop (which takes at least 1ms)
+            # so it is done when no other calls follow
+            flush = listening and (flush or performed > 0)
+
+            if performed == TASK_BATCH:
+                timeout = 0.0  # there might be more operations queued
+            elif flush:
+                timeout = FLUSH_DELAY / 1000
+            elif listening and self._ubus_sock is None:
+                timeout = LOOP_SLICE / 1000
+            else:
+                timeout = None
+
+            fds = [self._wakeup_r]
+            if listening and self._ubus_sock is not None:
+                fds.append(self._ubus_sock)
+            readable, _, _ = select.select(fds, [], [], timeout)
+
+            if flush and not readable:
+                ubus.loop(1)
+                flush = False
+
+            if self._wakeup_r in readable:
+                try:
+                    while self._wakeup_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+            if listening and self._ubus_sock is not None and self._ubus_sock in readable:
+                if self._ubus_sock_closed():
+                    # it would be readable forever
+                    logger.error("Connection to ubus was closed, falling back to polling.")
+                    self._close_ubus_sock()
+                ubus.loop(0)  # process available events without blocking
+            elif listening and self._ubus_sock is None:
+                ubus.loop(0)
+
+
+_dispatcher: typing.Optional[UbusDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> UbusDispatcher:
+    """ Returns the process-wide dispatcher (it is started on the first use)
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = UbusDispatcher()
+            _dispatcher.start()
+        return _dispatcher
+
+
+class _ModuleRoutes(object):
+    """ ubus listen patterns and a lookup of the events for a list of modules
+
+    Modules can contain glob patterns (e.g. "net*", "*wan"). ubus supports only a trailing "*",
+    so the other patterns are widened and the events are filtered using the lookup.
+    """
+
+    def __init__(self, modules: typing.Union[None, str, typing.List[str]]):
+        if modules is None:
+            modules = ["*"]
+        elif isinstance(modules, str):
+            modules = [modules]
+
+        self._globs = [OBJECT_PREFIX + e for e in modules]
+
+        patterns = set()
+        for glob in self._globs:
+            wildcard = re.search(r"[*?\[]", glob)
+            patterns.add(glob if wildcard is None else glob[: wildcard.start()] + "*")
+        # events matching several patterns would be delivered several times
+        self.patterns = sorted(
+            pattern
+            for pattern in patterns
+            if not any(
+                other != pattern and other.endswith("*") and pattern.startswith(other[:-1])
+                for other in patterns
+            )
+        )
+
+        # event name -> whether it is listened to
+        self._lookup: typing.Dict[str, bool] = {}
+
+    def __contains__(self, event: str) -> bool:
+        try:
+            return self._lookup[event]
+        except KeyError:
+            listened = any(fnmatch.fnmatchcase(event, glob) for glob in self._globs)
+            self._lookup[event] = listened
+            return listened
+
+
+def _prepare_notification(module, data):
+    module_name = module[len(OBJECT_PREFIX) :]
+    msg = {"module": module_name, "kind": "notification", "action": data["action"]}
+    msg_data = data.get("data", None)
+    if msg_data:
+        msg["data"] = msg_data
+    return msg
 
 
 class UbusSender(BaseSender):
-    def connect(self, socket_path, default_timeout=0):
+    def connect(self, socket_path, default_timeout=0, chunk_size=CHUNK_SIZE):
         """ connects to ubus
 
         :param socket_path: path to ubus socket
         :type socket_path: str
         :param default_timeout: default timeout for send operations (in ms)
         :type default_timeout: int
+        :param chunk_size: max size of data sent in a single ubus call (in characters),
+                           larger data are split into multipart chunks
+        :type chunk_size: int
         """
         self.default_timeout = default_timeout
+        self.chunk_size = chunk_size
+        self.dispatcher = get_dispatcher()
+        self.dispatcher.submit(self._connect, socket_path, default_timeout).result()
+        self.dispatcher.watch_objects().result()
 
+    def _connect(self, socket_path, default_timeout):
         if ubus.get_connected():
             connected_socket = ubus.get_socket_path()
             if socket_path == connected_socket:
@@ -58,7 +517,7 @@ class UbusSender(BaseSender):
                 )
                 self.disconnect()
         logger.debug("Trying to connect to ubus socket '%s'." % socket_path)
-        ubus.connect(socket_path)
+        self.dispatcher.connect(socket_path).result()
         logger.debug(
             "Connected to ubus socket '%s' (default_timeout=%d)." % (socket_path, default_timeout)
         )
@@ -68,23 +527,72 @@ class UbusSender(BaseSender):
         :param module: module which will be used
         :param action: action which will be called
         :param data: data for the request
+        :param timeout: timeout of the whole request including all multipart chunks
+                        (in ms, 0 => no timeout)
         :param controller_id: ignored for ubus
         :returns: reply
+        :raises TimeoutError: when the reply was not received in time
+        """
+        chunks = codec.encode_chunks(data, self.chunk_size) if data else None
+        return self._send_chunks(module, action, data, chunks, timeout)
+
+    def send_stream(
+        self,
+        module: str,
+        action: str,
+        stream: typing.Union[typing.IO, typing.Iterable[typing.Union[str, bytes]]],
+        timeout=None,
+        controller_id: str = None,
+    ):
+        """ send request which data are read from a stream
+
+        Only a single chunk is kept in memory, so it is suitable for very large data.
+
+        :param module: module which will be used
+        :param action: action which will be called
+        :param stream: file-like object or an iterable of str/bytes containing JSON encoded data
+                       (e.g. json.JSONEncoder().iterencode(data))
+        :param timeout: timeout of the whole request including all multipart chunks
+                        (in ms, 0 => no timeout)
+        :param controller_id: ignored for ubus
+        :returns: reply
+        :raises TimeoutError: when the reply was not received in time
+        """
+        chunks = codec.join_chunks(_iterstream(stream, self.chunk_size), self.chunk_size)
+        return self._send_chunks(module, action, None, chunks, timeout)
+
+    def _send_chunks(self, module, action, data, chunks, timeout):
+        """ sends the data as a single call or as multipart chunks when they don't fit a chunk
+
+        :param data: decoded data (None => they are decoded from chunks when needed)
+        :param chunks: iterator of encoded data chunks (None => no data)
         """
+        ubus_object = OBJECT_PREFIX + module
         timeout = self.default_timeout if timeout is None else timeout
-        ubus_object = "foris-controller-%s" % module
+        deadline = time.monotonic() + float(timeout) / 1000 if timeout else None
 
-        dumped_data = json.dumps(data if data else {})
+        if self.dispatcher.has_object(ubus_object) is False and not self._result(
+            self.dispatcher.lookup_object(ubus_object), deadline
+        ):
+            # fail before the data are encoded and sent
+            # (the miss is confirmed, the object might have been registered just now)
+            raise RuntimeError("Object '%s' not found (module is not available)." % ubus_object)
         request_id = str(uuid.uuid4())
 
-        logger.debug(
-            "Sending calling method '%s' in object '%s': %s"
-            % (action, ubus_object, dumped_data[:10000])
-        )
+        first = next(chunks, None) if chunks else None
+        second = next(chunks, None) if first is not None else None
 
-        if len(dumped_data) > 512 * 1024:
-            for data_part in _chunks(dumped_data, 512 * 1024):
-                ubus.call(
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Sending calling method '%s' in object '%s': %s",
+                action,
+                ubus_object,
+                (first or "{}")[:10000],
+            )
+
+        if second is not None:
+            for data_part in itertools.chain((first, second), chunks):
+                self._call(
                     ubus_object,
                     action,
                     {
@@ -93,8 +601,9 @@ class UbusSender(BaseSender):
                         "multipart": True,
                         "request_id": request_id,
                     },
+                    deadline,
                 )
-            res = ubus.call(
+            res = self._call(
                 ubus_object,
                 action,
                 {
@@ -103,9 +612,12 @@ class UbusSender(BaseSender):
                     "multipart": True,
                     "request_id": request_id,
                 },
+                deadline,
             )
         else:
-            res = ubus.call(
+            if data is None and first is not None:
+                data = codec.loads(first)
+            res = self._call(
                 ubus_object,
                 action,
                 {
@@ -114,12 +626,14 @@ class UbusSender(BaseSender):
                     "multipart": False,
                     "request_id": request_id,
                 },
+                deadline,
             )
 
         raw_response = "".join([e["data"] for e in res])
-        logger.debug("Message received: %s", raw_response[:10000])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Message received: %s", raw_response[:10000])
 
-        response = json.loads(raw_response)
+        response = codec.loads(raw_response)
 
         # Raise exception on error
         response["action"] = action
@@ -128,10 +642,39 @@ class UbusSender(BaseSender):
 
         return response.get("data", None)
 
+    def available_modules(self) -> typing.List[str]:
+        """ returns the modules which are currently registered on ubus (using a cached index)
+        """
+        objects = self.dispatcher.objects()
+        if objects is None:
+            self.dispatcher.watch_objects().result()
+            objects = self.dispatcher.objects() or frozenset()
+        return sorted(e[len(OBJECT_PREFIX) :] for e in objects)
+
+    def _call(self, ubus_object, action, arguments, deadline):
+        # the call itself is limited as well, this covers waiting in the queue
+        return self._result(self.dispatcher.call(ubus_object, action, arguments, deadline), deadline)
+
+    @staticmethod
+    def _result(future: concurrent.futures.Future, deadline: typing.Optional[float]):
+        """ waits for the result of the dispatcher task till the deadline
+
+        :raises TimeoutError: when the deadline was reached
+        """
+        try:
+            return future.result(None if deadline is None else max(deadline - time.monotonic(), 0))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError()
+
     def disconnect(self):
+        self._shutdown_send_executor()
+        self.dispatcher.submit(self._disconnect).result()
+
+    def _disconnect(self):
         if ubus.get_connected():
             logger.debug("Disconnecting from ubus.")
-            ubus.disconnect()
+            self.dispatcher.disconnect().result()
         else:
             logger.warning("Failed to disconnect from ubus (not connected)")
 
@@ -144,56 +687,137 @@ class UbusListener(BaseListener):
         :type socket_path: str
         :param handler: handler which will be called on obtained data and controller_id
         :type handler: callable
+        :param module: module or a list of modules to listen to, glob patterns can be used
+                       (None => all modules)
+        :type module: str or list
         :param timeout: how log is the listen period (in ms)
         :type timeout: int
         """
-        self.disconnecting = False
         self.timeout = timeout
-        self.module = module
+        self.routes = _ModuleRoutes(module)
         self.handler = handler
+        self.subscription = None
+        # events are passed from the ubus thread to the thread which is listening
+        self.notifications: queue.SimpleQueue = queue.SimpleQueue()
 
-        self.connected_before = ubus.get_connected()
-        if not self.connected_before:
-            logger.debug("Connecting to ubus (%s)." % socket_path)
-            ubus.connect(socket_path)
+        self.dispatcher = get_dispatcher()
+        self.connected_before = self.dispatcher.ensure_connected(socket_path).result()
 
     def listen(self):
+        def inner_handler(module, data):
+            if module in self.routes:
+                self.notifications.put((module, data))
+
+        logger.debug("Listening to %s." % ", ".join("'%s'" % e for e in self.routes.patterns))
+        self.subscription = self.dispatcher.subscribe(self.routes.patterns, inner_handler).result()
         logger.debug("Starting to listen.")
 
-        def inner_handler(module, data):
-            module_name = module[len("foris-controller-") :]
-            msg = {"module": module_name, "kind": "notification", "action": data["action"]}
-            msg_data = data.get("data", None)
-            if msg_data:
-                msg["data"] = msg_data
+        deadline = time.monotonic() + float(self.timeout) / 1000 if self.timeout else None
+        while True:
+            try:
+                if deadline is None:
+                    item = self.notifications.get()
+                else:
+                    item = self.notifications.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                logger.debug("Disconnected.")
+                break
+
+            msg = _prepare_notification(*item)
             logger.debug("Notification recieved %s." % msg)
             self.handler(msg, prepare_controller_id(None))
 
-        listen_object = "foris-controller-%s" % (self.module if self.module else "*")
-        logger.debug("Listening to '%s'." % listen_object)
-        ubus.listen((listen_object, inner_handler))
+    def disconnect(self):
+        """ disconnects from ubus
+        """
+        logger.debug("Disconnecting.")
+        if self.subscription is not None:
+            self.dispatcher.unsubscribe(self.subscription).result()
+            self.subscription = None
+        self.notifications.put(None)
+        self.dispatcher.submit(self._disconnect).result()
 
-        if self.timeout:
-            ubus.loop(self.timeout)
+    def _disconnect(self):
+        if self.connected_before:
+            logger.debug(
+                "Program was connected to ubus before listener started. -> don't diconnect"
+            )
+        elif ubus.get_connected():
+            logger.debug("Disconnecting from ubus.")
+            self.dispatcher.disconnect().result()
         else:
-            while True:
-                ubus.loop(500)
-                if self.disconnecting:
-                    if self.connected_before:
-                        logger.debug(
-                            "Program was connected to ubus before listener started. "
-                            "-> don't diconnect"
-                        )
-                    elif ubus.get_connected():
-                        logger.debug("Disconnecting from ubus.")
-                        ubus.disconnect()
-                    else:
-                        logger.warning("Failed to disconnect from ubus (not connected)")
-                    logger.debug("Disconnected.")
-                    break
+            logger.warning("Failed to disconnect from ubus (not connected)")
 
-    def disconnect(self):
-        """ disconnects from ubus
+
+class AsyncUbusSender(AsyncBaseSender):
+    async def connect(self, socket_path, default_timeout=0):
+        """ connects to ubus
+
+        The ubus binding is blocking and its connection is process-global,
+        so the calls are performed by the ubus dispatcher thread.
+
+        :param socket_path: path to ubus socket
+        :type socket_path: str
+        :param default_timeout: default timeout for send operations (in ms)
+        :type default_timeout: int
+        """
+        loop = asyncio.get_running_loop()
+        self.sender = await loop.run_in_executor(None, UbusSender, socket_path, default_timeout)
+
+    async def send(self, module: str, action: str, data: str, timeout=None, controller_id: str = None):
+        """ send request
+        :param module: module which will be used
+        :param action: action which will be called
+        :param data: data for the request
+        :param controller_id: ignored for ubus
+        :returns: reply
         """
-        logger.debug("Marked for disconnect.")
-        self.disconnecting = True
+        # encoding of the data and waiting for the calls is done in a worker thread
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.sender.send, module, action, data, timeout=timeout)
+        )
+
+    async def disconnect(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.sender.disconnect)
+
+
+class AsyncUbusListener(AsyncBaseListener):
+    async def connect(self, socket_path, module=None):
+        """ connects to ubus and starts to listen
+
+        Ubus events are processed by the ubus dispatcher thread
+        and passed to the asyncio loop.
+
+        :param socket_path: path to ubus socket
+        :type socket_path: str
+        :param module: module or a list of modules to listen to, glob patterns can be used
+                       (None => all modules)
+        :type module: str or list
+        """
+        loop = asyncio.get_running_loop()
+        self.dispatcher = get_dispatcher()
+        routes = _ModuleRoutes(module)
+
+        def inner_handler(module, data):
+            if module not in routes:
+                return
+            msg = _prepare_notification(module, data)
+            logger.debug("Notification recieved %s." % msg)
+            loop.call_soon_threadsafe(self._notify, msg, prepare_controller_id(None))
+
+        self.connected_before = await asyncio.wrap_future(
+            self.dispatcher.ensure_connected(socket_path)
+        )
+        logger.debug("Listening to %s." % ", ".join("'%s'" % e for e in routes.patterns))
+        self.subscription = await asyncio.wrap_future(
+            self.dispatcher.subscribe(routes.patterns, inner_handler)
+        )
+
+    async def disconnect(self):
+        logger.debug("Disconnecting.")
+        await asyncio.wrap_future(self.dispatcher.unsubscribe(self.subscription))
+        if not self.connected_before:
+            await asyncio.wrap_future(self.dispatcher.disconnect())
+        self._stop_notifications()
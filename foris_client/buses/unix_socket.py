@@ -17,22 +17,27 @@
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 #
 
-import json
+import asyncio
+import collections
+import concurrent.futures
 import logging
+import selectors
 import socket
 import struct
-import sys
 import threading
+import time
+import typing
 
-from .base import BaseSender, BaseListener, prepare_controller_id
-
-if sys.version_info < (3, 0):
-    import SocketServer
-else:
-    import socketserver
-
-    SocketServer = socketserver
-
+from .. import codec
+from ..utils import OrderedDispatcher
+from .base import (
+    AsyncBaseListener,
+    AsyncBaseSender,
+    BaseListener,
+    BaseSender,
+    ControllerError,
+    prepare_controller_id,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -41,73 +46,348 @@ def _normalize_timeout(timeout):
     return None if not timeout else float(timeout) / 1000  # 0 makes non-blocking socket
 
 
+def _recv_exactly(sock: socket.socket, size: int) -> bytearray:
+    """ Receives exactly `size` bytes directly into a preallocated buffer
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        # never ask for more than needed, the next message might follow
+        count = sock.recv_into(view[received:], size - received)
+        if not count:
+            raise ConnectionResetError("Connection to controller closed.")
+        received += count
+        if received < size:
+            logger.debug("Partial message recieved.")
+    return buffer
+
+
+def _sendall_buffers(sock: socket.socket, buffers: typing.List[bytes]):
+    """ Sends all the buffers using scatter-gather I/O (without joining them)
+    """
+    views = [memoryview(e) for e in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        # drop what was sent
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
 class UnixSocketSender(BaseSender):
-    def connect(self, socket_path, default_timeout=0):
+    def connect(self, socket_path, default_timeout=0, multiplexed=False):
         """ connects to unix-socket
 
         :param socket_path: path to unix-socket
         :type socket_path: str
         :param default_timeout: default timeout for send operations (in ms)
         :type default_timeout: int
+        :param multiplexed: pipeline the requests of all threads over the connection
+                            (replies are read by a background thread)
+        :type multiplexed: bool
         """
         self.default_timeout = _normalize_timeout(default_timeout)
+        self.multiplexed = multiplexed
+        # plain mode: whole request-reply exchange, multiplexed mode: writing of the requests
+        self.lock = threading.Lock()
+        self.pending: typing.Deque[concurrent.futures.Future] = collections.deque()
+        self.multiplexed_error: typing.Optional[Exception] = None
         logger.debug("Trying to connect to '%s'." % socket_path)
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sock.connect(socket_path)
+        if self.multiplexed:
+            self.reader = threading.Thread(
+                target=self._read_replies, name="foris-client-unix-socket-reader", daemon=True
+            )
+            self.reader.start()
         logger.debug(
-            "Connected to '%s' (default_timeout=%d)."
-            % (socket_path, 0 if not default_timeout else default_timeout)
+            "Connected to '%s' (default_timeout=%d, multiplexed=%s)."
+            % (socket_path, 0 if not default_timeout else default_timeout, multiplexed)
         )
 
-    def send(self, module: str, action: str, data: str, timeout=None, controller_id: str = None):
-        """ send request
-        :param module: module which will be used
-        :param action: action which will be called
-        :param data: data for the request
-        :param timeout: timeout for the request in ms (0=wait forever)
-        :param controller_id: ignored for unix-socket
-        :returns: reply
-        """
-        timeout = self.default_timeout if timeout is None else _normalize_timeout(timeout)
+    def _prepare_message(self, module: str, action: str, data: str) -> typing.List[bytes]:
         message = {"kind": "request", "module": module, "action": action}
 
         if data is not None:
             message["data"] = data
 
-        raw_message = json.dumps(message).encode("utf8")
-        logger.debug("Sending message (len=%d): %s" % (len(raw_message), raw_message))
-        length_bytes = struct.pack("I", len(raw_message))
-        self.sock.sendall(length_bytes + raw_message)
-        logger.debug("Message was send. Waiting for response.")
+        raw_message = codec.dumps(message)
+        logger.debug("Sending message (len=%d): %s", len(raw_message), raw_message)
+        return [struct.pack("I", len(raw_message)), raw_message]
 
-        self.sock.settimeout(timeout)
-        length = struct.unpack("I", self.sock.recv(4))[0]
+    def _recv_reply(self) -> dict:
+        length = struct.unpack("I", _recv_exactly(self.sock, 4))[0]
         logger.debug("Response length = %d." % length)
 
-        received = self.sock.recv(length)
-        recv_len = len(received)
-        while recv_len < length:
-            received += self.sock.recv(length)
-            recv_len = len(received)
-            logger.debug("Partial message recieved.")
-
+        received = _recv_exactly(self.sock, length)
         logger.debug("Message received: %s", received)
 
-        res = json.loads(received.decode("utf8"))
+        # codec accepts utf8 encoded bytes directly
+        return codec.loads(received)
 
+    def _process_reply(self, res: dict):
         # Raise exception on error
         self._raise_exception_on_error(res)
 
         return res.get("data", None)
 
+    def _read_replies(self):
+        """ Reads replies in multiplexed mode and resolves the futures in order
+        """
+        try:
+            while True:
+                res = self._recv_reply()
+                future = self.pending.popleft()
+                try:
+                    future.set_result(self._process_reply(res))
+                except Exception as exc:
+                    future.set_exception(exc)
+        except (OSError, ValueError) as exc:
+            logger.debug("Reader has stopped (%r).", exc)
+        with self.lock:
+            self.multiplexed_error = ConnectionResetError("Connection to controller closed.")
+            while self.pending:
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_exception(self.multiplexed_error)
+
+    def send_async(
+        self, module: str, action: str, data: str, timeout=None, controller_id: str = None
+    ) -> concurrent.futures.Future:
+        """ send request without waiting for the reply
+        :param module: module which will be used
+        :param action: action which will be called
+        :param data: data for the request
+        :param timeout: ignored in multiplexed mode (use future.result(timeout))
+        :param controller_id: ignored for unix-socket
+        :returns: future which contains the reply
+        """
+        if not self.multiplexed:
+            return super().send_async(module, action, data, timeout, controller_id)
+
+        message = self._prepare_message(module, action, data)
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        # request can't be taken back once it is written -> the future can't be cancelled
+        future.set_running_or_notify_cancel()
+        with self.lock:
+            if self.multiplexed_error:
+                future.set_exception(self.multiplexed_error)
+                return future
+            # the order of pending futures has to match the order of the requests
+            self.pending.append(future)
+            try:
+                _sendall_buffers(self.sock, message)
+            except OSError as exc:
+                # the stream might be corrupted -> let the reader to fail all pending requests
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                future.set_exception(exc)
+        logger.debug("Message was send. Waiting for response.")
+        return future
+
+    def send(self, module: str, action: str, data: str, timeout=None, controller_id: str = None):
+        """ send request
+        :param module: module which will be used
+        :param action: action which will be called
+        :param data: data for the request
+        :param timeout: timeout for the request in ms (0=wait forever)
+        :param controller_id: ignored for unix-socket
+        :returns: reply
+        """
+        timeout = self.default_timeout if timeout is None else _normalize_timeout(timeout)
+
+        if self.multiplexed:
+            try:
+                return self.send_async(module, action, data).result(timeout)
+            except concurrent.futures.TimeoutError:
+                raise socket.timeout("timed out")
+
+        message = self._prepare_message(module, action, data)
+        with self.lock:
+            _sendall_buffers(self.sock, message)
+            logger.debug("Message was send. Waiting for response.")
+
+            self.sock.settimeout(timeout)
+            res = self._recv_reply()
+
+        return self._process_reply(res)
+
     def disconnect(self):
         logger.debug("Closing connection.")
+        self._shutdown_send_executor()
+        if self.multiplexed:
+            try:
+                # wakes up the reader
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.reader.join()
         self.sock.close()
         logger.debug("Connection closed.")
 
 
+def _is_idle_socket_alive(sock: socket.socket) -> bool:
+    """ Checks the socket which is not waiting for any reply
+
+    Such socket should never be readable. EOF means that the controller has closed
+    the connection and unexpected data means that the stream is out of sync.
+    """
+    try:
+        # doesn't block and unlike select() it works for any fd number
+        sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+class UnixSocketSenderPool(BaseSender):
+    def connect(
+        self, socket_path, default_timeout=0, min_size=1, max_size=8, idle_timeout=60
+    ):
+        """ prepares a pool of connections to unix-socket
+
+        Each request borrows one connection. Dead connections are detected
+        and replaced by new ones transparently.
+
+        :param socket_path: path to unix-socket
+        :type socket_path: str
+        :param default_timeout: default timeout for send operations (in ms)
+        :type default_timeout: int
+        :param min_size: number of connections which are not closed when idle
+        :type min_size: int
+        :param max_size: max number of open connections (requests wait for a free one)
+        :type max_size: int
+        :param idle_timeout: connections above min_size are closed when unused for this long (in s)
+        :type idle_timeout: float
+        """
+        self.socket_path = socket_path
+        self.default_timeout = default_timeout
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle: typing.Deque[typing.Tuple[float, UnixSocketSender]] = collections.deque()
+        self.size = 0  # idle + borrowed connections
+        self.condition = threading.Condition()
+        self.closed = False
+
+        # requests can be processed in parallel up to the pool size
+        self._send_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_size, thread_name_prefix="foris-client-UnixSocketSenderPool"
+        )
+
+        for _ in range(min_size):
+            self.idle.append((time.monotonic(), self._open()))
+            self.size += 1
+
+    def _open(self) -> UnixSocketSender:
+        return UnixSocketSender(self.socket_path, self.default_timeout)
+
+    def _close(self, sender: UnixSocketSender):
+        """ closes the connection (condition needs to be held) """
+        self.size -= 1
+        try:
+            sender.disconnect()
+        except OSError:
+            pass
+
+    def _evict_idle(self):
+        """ closes connections which weren't used for a while (condition needs to be held) """
+        threshold = time.monotonic() - self.idle_timeout
+        while self.idle and self.size > self.min_size and self.idle[0][0] < threshold:
+            _, sender = self.idle.popleft()
+            logger.debug("Closing idle connection.")
+            self._close(sender)
+
+    def _acquire(self) -> UnixSocketSender:
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise ConnectionError("Pool is disconnected.")
+                self._evict_idle()
+                while self.idle:
+                    # the most recently used connection first
+                    _, sender = self.idle.pop()
+                    if _is_idle_socket_alive(sender.sock):
+                        return sender
+                    logger.warning("Connection to '%s' is dead, dropping it.", self.socket_path)
+                    self._close(sender)
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+                self.condition.wait()
+
+        try:
+            return self._open()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+    def _release(self, sender: UnixSocketSender, broken: bool = False):
+        with self.condition:
+            if broken or self.closed:
+                self._close(sender)
+            else:
+                self.idle.append((time.monotonic(), sender))
+            self.condition.notify()
+
+    def send(self, module: str, action: str, data: str, timeout=None, controller_id: str = None):
+        """ send request using one of the pooled connections
+        :param module: module which will be used
+        :param action: action which will be called
+        :param data: data for the request
+        :param timeout: timeout for the request in ms (0=wait forever)
+        :param controller_id: ignored for unix-socket
+        :returns: reply
+        """
+        for attempt in range(2):
+            sender = self._acquire()
+            try:
+                res = sender.send(module, action, data, timeout=timeout)
+            except BrokenPipeError:
+                # request hasn't been written -> it is safe to send it again
+                self._release(sender, broken=True)
+                if attempt:
+                    raise
+                logger.warning("Connection to '%s' is broken, reconnecting.", self.socket_path)
+                continue
+            except ControllerError:
+                self._release(sender)
+                raise
+            except Exception:
+                # timeouts or read errors leave the stream in an unknown state
+                self._release(sender, broken=True)
+                raise
+
+            self._release(sender)
+            return res
+
+    def disconnect(self):
+        logger.debug("Closing connections.")
+        with self.condition:
+            self.closed = True
+            while self.idle:
+                _, sender = self.idle.pop()
+                self._close(sender)
+            self.condition.notify_all()
+        self._shutdown_send_executor()
+        logger.debug("Connections closed.")
+
+
 class UnixSocketListener(BaseListener):
-    def connect(self, socket_path, handler, module=None, timeout=0):
+    READ_SIZE = 64 * 1024
+
+    def connect(self, socket_path, handler, module=None, timeout=0, workers=1):
         """ connects to ubus and starts to listen
 
         :param socket_path: path to ubus socket
@@ -116,45 +396,257 @@ class UnixSocketListener(BaseListener):
         :type handler: callable
         :param timeout: how log is the listen period (in ms)
         :type timeout: int
+        :param workers: max number of handlers running in parallel
+                        (notifications of a single module from a single connection
+                        are always handled in order)
+        :type workers: int
         """
         self.timeout = _normalize_timeout(timeout)
-        lock = threading.Lock()
+        self.handler = handler
+        self.module = module
 
-        class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
-            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen(socket.SOMAXCONN)
+        self.server.setblocking(False)
 
-        Server.timeout = self.timeout
+        # used to interrupt select() from disconnect()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
 
-        class Handler(SocketServer.StreamRequestHandler):
-            def handle(self):
-                while True:
-                    length_raw = self.rfile.read(4)
-                    if len(length_raw) != 4:
-                        break
-                    length = struct.unpack("I", length_raw)[0]
-                    data = json.loads(self.rfile.read(length))
-                    logger.debug("Notification recieved %s." % data)
-                    if not module or data["module"] == module:
-                        with lock:
-                            logger.debug("Triggering handler.")
-                            handler(data, prepare_controller_id(None))
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
 
-        self.server = Server(socket_path, Handler)
+        self.dispatcher = OrderedDispatcher(workers, "foris-client-listener")
+        self.stopped = False
+        self.listening = threading.Lock()
+
+    def _accept(self):
+        try:
+            connection, _ = self.server.accept()
+        except BlockingIOError:
+            return
+        connection.setblocking(False)
+        # buffer of the data which were not processed yet
+        self.selector.register(connection, selectors.EVENT_READ, bytearray())
+
+    def _close_connection(self, connection):
+        self.selector.unregister(connection)
+        connection.close()
+
+    def _read(self, connection, buffer):
+        try:
+            data = connection.recv(self.READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._close_connection(connection)
+            return
+
+        buffer += data
+        offset = 0
+        while len(buffer) - offset >= 4:
+            length = struct.unpack_from("I", buffer, offset)[0]
+            if len(buffer) - offset - 4 < length:
+                break
+            raw = bytes(buffer[offset + 4: offset + 4 + length])
+            offset += 4 + length
+            self._dispatch(connection, raw)
+        del buffer[:offset]
+
+    def _dispatch(self, connection, raw):
+        # decoded here so that the notifications can be dispatched according to their module
+        # (a controller usually sends all its notifications using a single connection)
+        try:
+            data = codec.loads(raw)
+        except ValueError:
+            logger.error("Notification not in JSON format.")
+            return
+        logger.debug("Notification recieved %s." % data)
+        module = data.get("module")
+        if self.module and module != self.module:
+            return
+        # handlers of a single module from a single connection are kept in order
+        self.dispatcher.submit((connection, module), lambda data=data: self._handle(data))
+
+    def _handle(self, data):
+        logger.debug("Triggering handler.")
+        self.handler(data, prepare_controller_id(None))
 
     def listen(self):
         logger.debug("Starting to listen.")
-        if self.timeout:
-            self.server.handle_request()
-        else:
-            self.server.serve_forever()
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        with self.listening:
+            while not self.stopped:
+                if deadline is None:
+                    wait = None
+                else:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        break
+
+                for key, _ in self.selector.select(wait):
+                    if key.fileobj is self.server:
+                        self._accept()
+                    elif key.fileobj is self.wakeup_r:
+                        try:
+                            self.wakeup_r.recv(self.READ_SIZE)
+                        except BlockingIOError:
+                            pass
+                    else:
+                        self._read(key.fileobj, key.data)
 
     def disconnect(self):
         logger.debug("Disconnecting from socket.")
+        self.stopped = True
         try:
-            self.server.shutdown()
+            self.wakeup_w.send(b"\0")
         except Exception:
             pass
+
+        # wait till listen() exits
+        with self.listening:
+            for key in list(self.selector.get_map().values()):
+                try:
+                    key.fileobj.close()
+                except Exception:
+                    pass
+            self.selector.close()
+            self.wakeup_w.close()
+
+        # don't wait for handlers (disconnect could be called from a handler)
+        self.dispatcher.shutdown(wait=False)
+
+
+class AsyncUnixSocketSender(AsyncBaseSender):
+    async def connect(self, socket_path, default_timeout=0):
+        """ connects to unix-socket
+
+        Requests are pipelined over a single connection. The controller replies
+        in the same order in which the requests were received.
+
+        :param socket_path: path to unix-socket
+        :type socket_path: str
+        :param default_timeout: default timeout for send operations (in ms)
+        :type default_timeout: int
+        """
+        self.default_timeout = _normalize_timeout(default_timeout)
+        logger.debug("Trying to connect to '%s'." % socket_path)
+        self.reader, self.writer = await asyncio.open_unix_connection(socket_path)
+        self.write_lock = asyncio.Lock()
+        self.pending: typing.Deque[asyncio.Future] = collections.deque()
+        # set when no more replies can be read
+        self.closed = False
+        self.reader_task = asyncio.ensure_future(self._read_replies())
+        logger.debug(
+            "Connected to '%s' (default_timeout=%d)."
+            % (socket_path, 0 if not default_timeout else default_timeout)
+        )
+
+    async def _read_replies(self):
         try:
-            self.server.server_close()
-        except Exception:
+            while True:
+                length = struct.unpack("I", await self.reader.readexactly(4))[0]
+                logger.debug("Response length = %d." % length)
+                received = await self.reader.readexactly(length)
+                if not self.pending:
+                    # replies can't be paired with the requests anymore
+                    logger.error("Unexpected reply received.")
+                    self.writer.close()
+                    break
+                future = self.pending.popleft()
+                # the future might have been cancelled (e.g. on timeout)
+                if not future.done():
+                    future.set_result(received)
+        except (asyncio.IncompleteReadError, ConnectionError) as exc:
+            logger.debug("Connection closed (%r).", exc)
+        finally:
+            # the reader might have been cancelled by disconnect() as well
+            self._fail_pending()
+
+    def _fail_pending(self):
+        self.closed = True
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionResetError("Connection to controller closed."))
+
+    async def send(self, module: str, action: str, data: str, timeout=None, controller_id: str = None):
+        """ send request
+        :param module: module which will be used
+        :param action: action which will be called
+        :param data: data for the request
+        :param timeout: timeout for the request in ms (0=wait forever)
+        :param controller_id: ignored for unix-socket
+        :returns: reply
+        """
+        timeout = self.default_timeout if timeout is None else _normalize_timeout(timeout)
+        message = {"kind": "request", "module": module, "action": action}
+
+        if data is not None:
+            message["data"] = data
+
+        raw_message = codec.dumps(message)
+        logger.debug("Sending message (len=%d): %s", len(raw_message), raw_message)
+        future = asyncio.get_running_loop().create_future()
+        async with self.write_lock:
+            if self.closed:
+                raise ConnectionResetError("Connection to controller closed.")
+            # order of the pending futures has to match the order of the written messages
+            self.pending.append(future)
+            self.writer.writelines([struct.pack("I", len(raw_message)), raw_message])
+            await self.writer.drain()
+        logger.debug("Message was send. Waiting for response.")
+
+        # keep the future pending on timeout, so that the late reply is dropped
+        received = await asyncio.wait_for(asyncio.shield(future), timeout)
+        logger.debug("Message received: %s", received)
+
+        res = codec.loads(received)
+
+        # Raise exception on error
+        self._raise_exception_on_error(res)
+
+        return res.get("data", None)
+
+    async def disconnect(self):
+        logger.debug("Closing connection.")
+        self.writer.close()
+        self.reader_task.cancel()
+        # requests in flight would never be resolved otherwise
+        self._fail_pending()
+        logger.debug("Connection closed.")
+
+
+class AsyncUnixSocketListener(AsyncBaseListener):
+    async def connect(self, socket_path, module=None):
+        """ starts a server on unix-socket which accepts notifications
+
+        :param socket_path: path to unix-socket
+        :type socket_path: str
+        :param module: listen only to notifications of this module (None => all modules)
+        :type module: str
+        """
+        self.module = module
+        self.server = await asyncio.start_unix_server(self._handle, socket_path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                length = struct.unpack("I", await reader.readexactly(4))[0]
+                data = codec.loads(await reader.readexactly(length))
+                logger.debug("Notification recieved %s." % data)
+                if not self.module or data["module"] == self.module:
+                    self._notify(data, prepare_controller_id(None))
+        except (asyncio.IncompleteReadError, ConnectionError):
             pass
+        finally:
+            writer.close()
+
+    async def disconnect(self):
+        logger.debug("Disconnecting from socket.")
+        self.server.close()
+        self._stop_notifications()
@@ -21,11 +21,11 @@
 
 import argparse
 import logging
-import json
 import typing
 import re
+import sys
 
-from foris_client import __version__
+from foris_client import __version__, codec
 from foris_client.utils import read_passwd_file
 
 logger = logging.getLogger("foris_client")
@@ -48,6 +48,31 @@ except ModuleNotFoundError:
     pass
 
 
+def send_many(sender, options, data, controller_ids):
+    output = open(options.output, "w") if options.output else sys.stdout
+    failed = False
+    try:
+        for controller_id, result in sender.send_many(
+            options.module,
+            options.action,
+            data,
+            controller_ids,
+            concurrency=options.concurrency,
+        ):
+            if isinstance(result, Exception):
+                logger.error("Request for '%s' failed: %r", controller_id, result)
+                failed = True
+                continue
+            output.write(f"{controller_id} {codec.dumps_str(result)}\n")
+            output.flush()
+    finally:
+        if options.output:
+            output.close()
+
+    if failed:
+        sys.exit(1)
+
+
 def main():
     # Parse the command line options
     parser = argparse.ArgumentParser(prog="foris-client")
@@ -124,7 +149,17 @@ def main():
         mqtt_parser.add_argument(
             "--controller-id",
             type=lambda x: re.match(r"[0-9a-zA-Z]{16}", x).group().upper(),
-            help="sets which controller on the messages bus should be configured (8 bytes is hex)",
+            action="append",
+            help="sets which controller on the messages bus should be configured (8 bytes is hex)"
+            "; when repeated the request is sent to all the controllers and '<id> <json>' "
+            "lines are printed",
+        )
+        mqtt_parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=64,
+            help="max number of controllers processing the request at the same time "
+            "(when --controller-id is repeated)",
         )
         mqtt_parser.add_argument(
             "--passwd-file",
@@ -140,6 +175,7 @@ def main():
     else:
         logging.basicConfig()
     logger.debug("Version %s" % __version__)
+    logger.debug("Using '%s' JSON codec." % codec.NAME)
 
     if options.bus == "ubus":
         from foris_client.buses.ubus import UbusSender
@@ -163,23 +199,34 @@ def main():
             options.timeout,
             tls_files=options.tls_files,
             credentials=options.passwd_file,
+            ready_timeout=options.timeout,
         )
 
-    data = None
-    if options.input:
-        with open(options.input) as f:
-            data = json.load(f)
+    controller_ids = (options.controller_id if options.bus == "mqtt" else None) or [None]
+    kwargs = {"controller_id": controller_ids[0]} if options.bus == "mqtt" else {}
+    if options.input and options.bus == "ubus":
+        # input file is streamed in chunks (it is not loaded into the memory at once)
+        with open(options.input, "rb") as f:
+            response = sender.send_stream(options.module, options.action, f)
+    else:
+        data = None
+        if options.input:
+            with open(options.input, "rb") as f:
+                data = codec.loads(f.read())
+
+        if options.json:
+            data = codec.loads(options.json)
 
-    if options.json:
-        data = json.loads(options.json)
+        if len(controller_ids) > 1:
+            send_many(sender, options, data, controller_ids)
+            return
 
-    kwargs = {"controller_id": options.controller_id} if options.bus == "mqtt" else {}
-    response = sender.send(options.module, options.action, data, **kwargs)
+        response = sender.send(options.module, options.action, data, **kwargs)
     if not options.output:
-        print(json.dumps(response))
+        print(codec.dumps_str(response))
     else:
-        with open(options.output, "w") as f:
-            json.dump(response, f)
+        with open(options.output, "wb") as f:
+            f.write(codec.dumps(response))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+#
+# foris-client
+# Copyright (C) 2026 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+""" JSON encoding/decoding which is shared by all buses
+
+The fastest available implementation is picked on import (orjson, stdlib json as a fallback).
+Both dumps() and loads() work with utf8 encoded bytes so no extra conversions are needed.
+"""
+
+import json
+import typing
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+
+if orjson:
+    NAME = "orjson"
+
+    def dumps(obj: typing.Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def dumps_str(obj: typing.Any) -> str:
+        return dumps(obj).decode("utf8")
+
+    # accepts bytes, bytearray, memoryview and str
+    loads = orjson.loads
+
+else:
+    NAME = "json"
+
+    def dumps(obj: typing.Any) -> bytes:
+        # output is ASCII only (non-ASCII characters are escaped)
+        return json.dumps(obj).encode("utf8")
+
+    dumps_str = json.dumps
+
+    # accepts bytes, bytearray and str
+    loads = json.loads
+
+
+def _iterencode(obj, size: int) -> typing.Iterator[str]:
+    """ Encodes a large container or string to JSON piece by piece
+
+    Items which fit `size` are encoded by a single codec call, only the larger
+    containers are walked through and the longer strings are split.
+    """
+    if isinstance(obj, dict):
+        yield "{"
+        for i, (key, value) in enumerate(obj.items()):
+            if not isinstance(key, str):
+                key = dumps_str(key)  # same conversion as json.dumps does (e.g. 1 -> "1")
+            yield ("," if i else "") + dumps_str(key) + ":"
+            yield from _iterencode_item(value, size, len(obj) == 1)
+        yield "}"
+    elif isinstance(obj, (list, tuple)):
+        yield "["
+        for i, value in enumerate(obj):
+            if i:
+                yield ","
+            yield from _iterencode_item(value, size, len(obj) == 1)
+        yield "]"
+    else:
+        yield '"'
+        for i in range(0, len(obj), size):
+            yield dumps_str(obj[i : i + size])[1:-1]
+        yield '"'
+
+
+def _iterencode_item(obj, size: int, large: bool) -> typing.Iterator[str]:
+    """ Encodes an item of a large container
+
+    :param large: the item is known to be large (the only item of a large container),
+                  so it is not encoded as a whole just to find it out
+    """
+    if not isinstance(obj, (dict, list, tuple, str)):
+        yield dumps_str(obj)
+        return
+    if not large:
+        encoded = dumps_str(obj)
+        if len(encoded) <= size:
+            yield encoded
+            return
+        del encoded  # encoded again piece by piece
+    yield from _iterencode(obj, size)
+
+
+def encode_chunks(data, size: int) -> typing.Iterator[str]:
+    """ Encodes the data to JSON chunks of `size` characters
+
+    Data which fit a single chunk are encoded by a single codec call. Larger data
+    are encoded lazily, so the whole encoded data are not kept in memory while
+    the chunks are being sent.
+    """
+    encoded = dumps_str(data)
+    if len(encoded) <= size:
+        return iter((encoded,))
+    del encoded
+    return join_chunks(_iterencode(data, size), size)
+
+
+def join_chunks(pieces: typing.Iterable[str], size: int) -> typing.Iterator[str]:
+    """ Joins the pieces to chunks of `size` characters (the last one can be shorter)
+    """
+    buffer: typing.List[str] = []
+    buffered = 0
+    for piece in pieces:
+        offset = 0
+        while offset < len(piece):
+            part = piece[offset : offset + size - buffered]
+            offset += len(part)
+            buffer.append(part)
+            buffered += len(part)
+            if buffered == size:
+                yield "".join(buffer)
+                buffer, buffered = [], 0
+    if buffer:
+        yield "".join(buffer)
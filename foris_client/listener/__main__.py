@@ -21,12 +21,11 @@
 
 import argparse
 import logging
-import json
 import os
 import typing
 import re
 
-from foris_client import __version__
+from foris_client import __version__, codec
 from foris_client.utils import read_passwd_file
 
 logger = logging.getLogger("foris_listener")
@@ -51,6 +50,13 @@ except ModuleNotFoundError:
     pass
 
 
+def parse_shard(value: str) -> typing.Tuple[int, int]:
+    match = re.match(r"^(\d+)/(\d+)$", value)
+    if not match:
+        raise argparse.ArgumentTypeError("'%s' is not in INDEX/COUNT format" % value)
+    return int(match.group(1)), int(match.group(2))
+
+
 def main():
     # Parse the command line options
     parser = argparse.ArgumentParser(prog="foris-listener")
@@ -67,7 +73,14 @@ def main():
         help="where to store output json data",
     )
     parser.add_argument(
-        "-m", "--module", dest="module", help="to listen", required=False, type=str, default=None
+        "-m",
+        "--module",
+        dest="module",
+        help="to listen (can be repeated and glob patterns can be used for ubus)",
+        required=False,
+        type=str,
+        action="append",
+        default=None,
     )
     parser.add_argument(
         "-t",
@@ -117,8 +130,28 @@ def main():
             help="path to passwd file (first record will be used to authenticate)",
             default=None,
         )
+        mqtt_parser.add_argument(
+            "--group",
+            default=None,
+            help="share the notifications among the listeners of the same group",
+        )
+        mqtt_parser.add_argument(
+            "--shard",
+            type=parse_shard,
+            default=None,
+            metavar="INDEX/COUNT",
+            help="process only the notifications of the controllers within the shard "
+            "(keeps the order of the notifications of a controller)",
+        )
 
     options = parser.parse_args()
+    if options.bus != "ubus" and options.module and len(options.module) > 1:
+        parser.error("multiple modules (-m) can be used only with ubus")
+    if options.bus == "mqtt":
+        if options.group and options.shard:
+            parser.error("--group and --shard can't be used together")
+        if options.shard and not 0 <= options.shard[0] < options.shard[1]:
+            parser.error("shard INDEX has to be lower than COUNT")
 
     logging_format = "%(levelname)s:%(name)s:%(message)." + str(LOGGER_MAX_LEN) + "s"
     if options.debug:
@@ -126,6 +159,7 @@ def main():
     else:
         logging.basicConfig(format=logging_format)
     logger.debug("Version %s" % __version__)
+    logger.debug("Using '%s' JSON codec." % codec.NAME)
 
     if options.log_file:
         logging_handler = logging.FileHandler(options.log_file)
@@ -141,7 +175,7 @@ def main():
         f.flush()
 
         def print_to_file(data, controller_id):
-            f.write(f"{controller_id} {json.dumps(data)}\n")
+            f.write(f"{controller_id} {codec.dumps_str(data)}\n")
             f.flush()
 
         handler = print_to_file
@@ -149,7 +183,7 @@ def main():
         f = None
 
         def print_to_stdout(data, controller_id):
-            print(f"{controller_id} {json.dumps(data)}")
+            print(f"{controller_id} {codec.dumps_str(data)}")
 
         handler = print_to_stdout
 
@@ -168,7 +202,9 @@ def main():
                 os.unlink(options.path)
             except OSError:
                 pass
-            listener = UnixSocketListener(options.path, handler, options.module, options.timeout)
+            listener = UnixSocketListener(
+                options.path, handler, options.module and options.module[0], options.timeout
+            )
 
         elif options.bus == "mqtt":
             from foris_client.buses.mqtt import MqttListener
@@ -178,11 +214,13 @@ def main():
                 options.host,
                 options.port,
                 handler,
-                options.module,
+                options.module and options.module[0],
                 options.timeout,
                 tls_files=options.tls_files,
                 controller_id=getattr(options, "controller_id", "+"),
                 credentials=options.passwd_file,
+                group=options.group,
+                shard=options.shard,
             )
 
         listener.listen()
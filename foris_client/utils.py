@@ -1,9 +1,300 @@
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import logging
 import re
+import threading
+import time
 import typing
 
+logger = logging.getLogger(__name__)
+
 
 def read_passwd_file(path: str) -> typing.Tuple[str]:
     """ Returns username and password from passwd file
     """
     with open(path, "r") as f:
         return re.match(r"^([^:]+):(.*)$", f.readlines()[0][:-1]).groups()
+
+
+class ExpiryIndex(object):
+    """ Min-heap of (timestamp, key) records which is used to find expired keys lazily
+
+    Refreshing a key just pushes a new record. Outdated records are popped as well,
+    so the caller is supposed to compare the popped timestamp with the current one.
+    """
+
+    def __init__(self):
+        self._heap: typing.List[typing.Tuple[float, int, typing.Hashable]] = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, timestamp: float, key: typing.Hashable):
+        heapq.heappush(self._heap, (timestamp, next(self._counter), key))
+
+    def earliest(self) -> typing.Optional[float]:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_older(
+        self, threshold: float, limit: typing.Optional[int] = None
+    ) -> typing.Iterator[typing.Tuple[float, typing.Hashable]]:
+        """ Pops records older than threshold
+
+        :param threshold: records with timestamp lower than this are popped
+        :param limit: max number of popped records (None => unlimited)
+        """
+        popped = 0
+        while self._heap and self._heap[0][0] < threshold:
+            if limit is not None and popped >= limit:
+                break
+            timestamp, _, key = heapq.heappop(self._heap)
+            popped += 1
+            yield timestamp, key
+
+
+class Scheduler(threading.Thread):
+    """ Calls the callbacks at given times (in time.monotonic()) within a single thread
+    """
+
+    def __init__(self, name: str):
+        self._index = ExpiryIndex()
+        self._condition = threading.Condition()
+        self._stopped = False
+        super().__init__(group=None, target=None, name=name, daemon=True)
+
+    def schedule(self, when: float, callback: typing.Callable[[], None]):
+        with self._condition:
+            earliest = self._index.earliest()
+            self._index.push(when, callback)
+            if earliest is None or when < earliest:
+                self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopped:
+                        return
+                    now = time.monotonic()
+                    due = [callback for _, callback in self._index.pop_older(now)]
+                    if due:
+                        break
+                    earliest = self._index.earliest()
+                    self._condition.wait(None if earliest is None else earliest - now)
+
+            for callback in due:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception("Scheduled callback %r has failed.", callback)
+
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_DROP_NEWEST = "drop-newest"
+
+
+class OrderedDispatcher(object):
+    """ Runs tasks in a bounded pool of threads, tasks with the same key are run in order
+
+    Tasks of different keys are run in parallel. A key with many tasks
+    releases its thread from time to time so that other keys are not starved.
+
+    The number of queued (not started) tasks can be limited by maxsize. When the queue is full
+    the submitter is blocked or the oldest / the newest task is dropped (see OVERFLOW_*).
+
+    Tasks submitted after shutdown() are dropped, the already queued ones are still run.
+    """
+
+    BATCH = 16
+
+    def __init__(
+        self, workers: int, name: str, maxsize: int = 0, overflow: str = OVERFLOW_BLOCK
+    ):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            raise ValueError("Unknown overflow policy '%s'" % overflow)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name
+        )
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._maxsize = maxsize
+        self._overflow = overflow
+        self._counter = itertools.count()
+        # queues of keys which have a task submitted or running
+        self._queues: typing.Dict[
+            typing.Hashable, typing.Deque[typing.Tuple[int, typing.Callable[[], None]]]
+        ] = {}
+        # queued tasks in the order of submission (sequence number -> key) to find the oldest one
+        self._queued: typing.Optional[typing.OrderedDict[int, typing.Hashable]] = (
+            collections.OrderedDict() if maxsize and overflow == OVERFLOW_DROP_OLDEST else None
+        )
+        # number of the queued tasks (which haven't started yet)
+        self.depth = 0
+        self.dropped = 0
+        self._closed = False
+
+    def submit(self, key: typing.Hashable, task: typing.Callable[[], None]) -> bool:
+        """ Queues the task
+
+        :returns: False when the task was dropped
+        """
+        with self._lock:
+            if self._closed:
+                self.dropped += 1
+                return False
+            if self._maxsize and self.depth >= self._maxsize:
+                if self._overflow == OVERFLOW_DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self._overflow == OVERFLOW_DROP_OLDEST:
+                    # the oldest task is always the first one in the queue of its key
+                    _, oldest_key = self._queued.popitem(last=False)
+                    self._queues[oldest_key].popleft()
+                    self.depth -= 1
+                    self.dropped += 1
+                else:
+                    while self.depth >= self._maxsize and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        self.dropped += 1
+                        return False
+
+            seq = next(self._counter)
+            if self._queued is not None:
+                self._queued[seq] = key
+            self.depth += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((seq, task))
+                return True
+            self._queues[key] = collections.deque([(seq, task)])
+            # submitted within the lock, so that it is not raced by shutdown()
+            self._executor.submit(self._drain, key)
+        return True
+
+    def _drain(self, key: typing.Hashable):
+        while True:
+            for _ in range(self.BATCH):
+                with self._lock:
+                    queue = self._queues[key]
+                    if not queue:
+                        del self._queues[key]
+                        return
+                    seq, task = queue.popleft()
+                    if self._queued is not None:
+                        del self._queued[seq]
+                    self.depth -= 1
+                    if self._maxsize:
+                        self._not_full.notify()
+                try:
+                    task()
+                except Exception:
+                    logger.exception("Dispatched task %r has failed.", task)
+
+            with self._lock:
+                if not self._queues[key]:
+                    del self._queues[key]
+                    return
+                if not self._closed:
+                    # continue later
+                    self._executor.submit(self._drain, key)
+                    return
+            # the executor doesn't accept new work after shutdown, so the rest is drained here
+
+    def shutdown(self, wait: bool = True):
+        """ Stops accepting new tasks (the queued ones are still run)
+        """
+        with self._lock:
+            self._closed = True
+            # wakes up the blocked submitters
+            self._not_full.notify_all()
+        self._executor.shutdown(wait=wait)
+
+
+class TopicRouter(object):
+    """ Routes MQTT topics to handlers using a trie of topic levels (no regex matching)
+
+    Patterns are split on "/" and "+" matches any single level. Values of the "+" levels
+    are passed to the handler as positional arguments followed by the extra arguments of route().
+    Exact levels take precedence over "+".
+    """
+
+    # key of the handler within a trie node (topic levels are always strings)
+    _HANDLER = None
+
+    def __init__(self):
+        self._root: dict = {}
+
+    def add(self, pattern: str, handler: typing.Callable[..., None]):
+        node = self._root
+        for level in pattern.split("/"):
+            node = node.setdefault(level, {})
+        node[self._HANDLER] = handler
+
+    def match(
+        self, topic: str
+    ) -> typing.Optional[typing.Tuple[typing.Callable[..., None], typing.List[str]]]:
+        """ Finds the handler for the topic
+
+        :returns: handler and values of "+" levels or None when no pattern matches
+        """
+        levels = topic.split("/")
+
+        # fast path - greedy walk (exact level first) without backtracking
+        node = self._root
+        values = []
+        for level in levels:
+            child = node.get(level)
+            if child is None:
+                child = node.get("+")
+                if child is None:
+                    break
+                values.append(level)
+            node = child
+        else:
+            handler = node.get(self._HANDLER)
+            if handler:
+                return handler, values
+
+        return self._match(self._root, levels, 0)
+
+    def _match(self, node: dict, levels: typing.List[str], index: int):
+        if index == len(levels):
+            handler = node.get(self._HANDLER)
+            return (handler, []) if handler else None
+
+        child = node.get(levels[index])
+        if child is not None:
+            found = self._match(child, levels, index + 1)
+            if found:
+                return found
+
+        child = node.get("+")
+        if child is not None:
+            found = self._match(child, levels, index + 1)
+            if found:
+                found[1].insert(0, levels[index])
+                return found
+
+        return None
+
+    def route(self, topic: str, *args) -> bool:
+        """ Calls the handler of the topic with values of "+" levels and args
+
+        :returns: False when no pattern matches
+        """
+        found = self.match(topic)
+        if not found:
+            return False
+        handler, values = found
+        handler(*values, *args)
+        return True
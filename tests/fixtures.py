@@ -388,6 +388,38 @@ def ubus_client(ubusd_test, ubus_controller):
     sender.disconnect()
 
 
+# stand-in ubus object which replies after a long delay
+SLOW_UBUS_OBJECT = """
+import json
+import sys
+import time
+import ubus
+
+def get(handler, data):
+    time.sleep(3)
+    handler.reply({"data": json.dumps({"data": {}})})
+
+ubus.connect(sys.argv[1])
+signature = {
+    "payload": ubus.BLOBMSG_TYPE_TABLE,
+    "final": ubus.BLOBMSG_TYPE_BOOL,
+    "multipart": ubus.BLOBMSG_TYPE_BOOL,
+    "request_id": ubus.BLOBMSG_TYPE_STRING,
+}
+ubus.add("foris-controller-slow", {"get": {"method": get, "signature": signature}})
+ubus.loop()
+"""
+
+
+@pytest.fixture(scope="function")
+def ubus_slow_object(ubusd_test):
+    process = subprocess.Popen(["python", "-c", SLOW_UBUS_OBJECT, UBUS_PATH])
+    wait_process = subprocess.Popen(["ubus", "wait_for", "foris-controller-slow", "-s", UBUS_PATH])
+    wait_process.wait()
+    yield process
+    process.kill()
+
+
 @pytest.fixture(scope="function")
 def unix_socket_client(unix_controller):
     from foris_client.buses.unix_socket import UnixSocketSender
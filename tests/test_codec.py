@@ -0,0 +1,142 @@
+#
+# foris-client
+# Copyright (C) 2026 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import json
+import pytest
+import time
+import uuid
+
+from foris_client import codec
+
+
+def _implementation(name):
+    if name == "orjson":
+        orjson = pytest.importorskip("orjson")
+        return (
+            lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+            orjson.loads,
+        )
+    return lambda obj: json.dumps(obj).encode("utf8"), json.loads
+
+
+def _payload(name):
+    if name == "echo":
+        return {"reply_msg_id": str(uuid.uuid4()), "data": {"reply_msg": {"id": 1, "text": "ěščř"}}}
+    # config-like reply
+    return {
+        "reply_msg_id": str(uuid.uuid4()),
+        "data": {
+            "config": [
+                {
+                    "name": "config%d" % i,
+                    "sections": [
+                        {
+                            "type": "interface",
+                            "name": "lan%d" % j,
+                            "anonymous": False,
+                            "options": {"proto": "static", "ipaddr": "192.168.%d.1" % j, "mtu": 1500},
+                        }
+                        for j in range(30)
+                    ],
+                }
+                for i in range(20)
+            ]
+        },
+    }
+
+
+def test_codec():
+    data = _payload("config")
+    assert codec.NAME in ("orjson", "json")
+    assert codec.loads(codec.dumps(data)) == data
+    assert codec.loads(codec.dumps_str(data)) == data
+    # same conversion of non-str keys as json.dumps does
+    assert codec.loads(codec.dumps({1: None})) == {"1": None}
+
+
+@pytest.mark.parametrize("payload", ["echo", "config"])
+@pytest.mark.parametrize("implementation", ["orjson", "json"])
+def test_codec_speed(implementation, payload):
+    dumps, loads = _implementation(implementation)
+    data = _payload(payload)
+    raw = dumps(data)
+    assert loads(raw) == data
+    count = 10000 if payload == "echo" else 100
+
+    start = time.perf_counter()
+    for _ in range(count):
+        dumps(data)
+    dumps_duration = (time.perf_counter() - start) / count
+
+    start = time.perf_counter()
+    for _ in range(count):
+        loads(raw)
+    loads_duration = (time.perf_counter() - start) / count
+
+    print(
+        f"{implementation} {payload} ({len(raw)} B): "
+        f"dumps {dumps_duration * 1e6:.1f} us, loads {loads_duration * 1e6:.1f} us"
+    )
+
+
+@pytest.mark.parametrize("count", [1, 1500], ids=["single", "multipart"])
+def test_encode_chunks(count):
+    size = 512 * 1024  # CHUNK_SIZE of ubus
+    # config-like data (~5KB per item)
+    data = {
+        "config": [
+            {
+                "name": "config%d" % i,
+                "sections": [
+                    {
+                        "type": "interface",
+                        "name": "lan%d" % j,
+                        "options": {"proto": "static", "ipaddr": "192.168.%d.1" % j, "list": [1, 2.5, None]},
+                    }
+                    for j in range(30)
+                ],
+            }
+            for i in range(count)
+        ]
+    }
+    chunks = list(codec.encode_chunks(data, size))
+    assert json.loads("".join(chunks)) == data
+    assert all(len(e) <= size for e in chunks)
+    assert (len(chunks) == 1) == (count == 1)
+
+    def measure(function):
+        durations = []
+        for _ in range(5):
+            start = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - start)
+        return min(durations)
+
+    baseline = measure(lambda: json.dumps(data))
+    duration = measure(lambda: "".join(codec.encode_chunks(data, size)))
+    print("%d chunk(s): json.dumps %.0f us, encoded %.0f us" % (len(chunks), baseline * 1e6, duration * 1e6))
+
+
+def test_encode_chunks_large_items():
+    size = 1024
+    # non-str keys, long strings and nested large containers
+    data = {1: ["ěščř" * size, {"x": "y" * size}, [{"a": 1}] * size], "z": None}
+    chunks = list(codec.encode_chunks(data, size))
+    assert json.loads("".join(chunks)) == json.loads(json.dumps(data))
+    assert all(len(e) == size for e in chunks[:-1])
@@ -18,17 +18,36 @@
 #
 
 
+import asyncio
+import concurrent.futures
 import pytest
 import random
 import string
+import threading
+import time
 
-from foris_client.buses.mqtt import MqttSender
-from foris_client.buses.base import ControllerError
+from foris_client.buses.mqtt import (
+    ANNOUNCER_PERIOD_REQUIRED,
+    EXPIRY_BATCH,
+    RETENTION_TIMEOUT,
+    AsyncMqttListener,
+    AsyncMqttSender,
+    ControllerRegistry,
+    MqttListener,
+    MqttSender,
+    ReplyListener,
+    controller_shard,
+    mqtt_client_extra,
+)
+from foris_client.buses.base import ControllerError, ControllerMissing
+from foris_client.utils import ExpiryIndex, Scheduler
+from paho.mqtt import client as mqtt
 
 from .fixtures import (
     mqtt_controller,
     mqtt_client,
     MQTT_HOST,
+    MQTT_ID,
     mqtt_listener,
     mqtt_notify,
     mosquitto_test,
@@ -72,6 +91,361 @@ def test_timeout(mosquitto_test, mqtt_listener, mqtt_controller, mqtt_client):
     sender.send("about", "get", None)
 
 
+@pytest.mark.parametrize("threads", [1, 8, 32])
+def test_parallel_requests(mosquitto_test, mqtt_listener, mqtt_controller, mqtt_client, threads):
+    count = 128
+
+    def send(i):
+        return mqtt_client.send("echo", "echo", {"request_msg": {"id": i}})
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(send, range(count)))
+    elapsed = time.monotonic() - start
+    print(f"{threads} threads: {count / elapsed:.1f} requests/s")
+
+    assert results == [{"reply_msg": {"id": i}} for i in range(count)]
+
+
+def test_send_async(mosquitto_test, mqtt_listener, mqtt_controller, mqtt_client):
+    futures = [
+        mqtt_client.send_async("echo", "echo", {"request_msg": {"id": i}}) for i in range(32)
+    ]
+    failing = mqtt_client.send_async("about", "non-existing", None)
+    assert [e.result() for e in futures] == [{"reply_msg": {"id": i}} for i in range(32)]
+    with pytest.raises(ControllerError):
+        failing.result()
+
+
+def test_send_many(mosquitto_test, mqtt_listener, mqtt_controller, mqtt_client):
+    missing_id = "0000000000000001"
+    results = list(
+        mqtt_client.send_many(
+            "echo", "echo", {"request_msg": {"id": 1}}, [MQTT_ID] * 16 + [missing_id], concurrency=4
+        )
+    )
+    assert len(results) == 17
+    assert [e for e in results if e[0] == MQTT_ID] == [(MQTT_ID, {"reply_msg": {"id": 1}})] * 16
+    assert isinstance(dict(results)[missing_id], ControllerMissing)
+
+    results = list(mqtt_client.send_many("about", "non-existing", None, [MQTT_ID]))
+    assert len(results) == 1
+    assert isinstance(results[0][1], ControllerError)
+
+    # None (local controller) doesn't end the iteration
+    results = list(mqtt_client.send_many("about", "get", None, [None, MQTT_ID], timeout=300))
+    assert [e[0] for e in results if e[0] is None] == [None]
+    assert len(results) == 2
+
+
+def test_expire_replies():
+    replies = {}
+    listener = ReplyListener(
+        replies=replies,
+        replies_lock=threading.Lock(),
+        replies_expiry=ExpiryIndex(),
+        registry=ControllerRegistry(Scheduler("test-scheduler")),
+        host=MQTT_HOST,
+        port=MQTT_PORT,
+        client=mqtt.Client(**mqtt_client_extra()),
+        subscribed=threading.Event(),
+    )
+    now = time.monotonic()
+    expired = now - RETENTION_TIMEOUT - 1
+    for i in range(EXPIRY_BATCH + 1):
+        replies[(MQTT_ID, "expired%d" % i)] = [expired, None, False]
+        listener.replies_expiry.push(expired, (MQTT_ID, "expired%d" % i))
+    # reused reply_id (its outdated record is still in the index)
+    replies[(MQTT_ID, "reused")] = [now, None, False]
+    listener.replies_expiry.push(expired, (MQTT_ID, "reused"))
+    listener.replies_expiry.push(now, (MQTT_ID, "reused"))
+
+    # a limited amount is removed at once
+    with listener.replies_lock:
+        listener._expire_replies()
+    assert set(replies) == {(MQTT_ID, "expired%d" % EXPIRY_BATCH), (MQTT_ID, "reused")}
+
+    with listener.replies_lock:
+        listener._expire_replies()
+    assert set(replies) == {(MQTT_ID, "reused")}
+    assert len(listener.replies_expiry) == 1
+
+
+def test_first_send(mosquitto_test, mqtt_controller, mqtt_client):
+    # mqtt_client waits for the controller to be ready
+    start = time.monotonic()
+    sender = MqttSender(MQTT_HOST, MQTT_PORT, ready_timeout=5000)
+    response = sender.send("echo", "echo", {"request_msg": {"id": 1}})
+    assert response == {"reply_msg": {"id": 1}}
+    # no resend is required
+    assert time.monotonic() - start < ANNOUNCER_PERIOD_REQUIRED
+
+    assert sender.wait_ready(ANNOUNCER_PERIOD_REQUIRED * 2000, controller_id=MQTT_ID)
+    assert not sender.wait_ready(500, controller_id="0000000000000003")
+    sender.disconnect()
+
+
+def test_disconnect_pending(mosquitto_test, mqtt_controller, mqtt_client):
+    sender = MqttSender(MQTT_HOST, MQTT_PORT, ready_timeout=5000)
+    # controller which doesn't exist (it is not known yet whether it advertises itself)
+    future = sender.send_async("about", "get", None, timeout=0, controller_id="0000000000000003")
+    assert not future.done()
+
+    start = time.monotonic()
+    sender.disconnect()
+    with pytest.raises(ConnectionError):
+        future.result(1)
+    assert not sender.pending
+
+    # new requests are rejected right away
+    with pytest.raises(ConnectionError):
+        sender.send("echo", "echo", {"request_msg": {"id": 1}})
+    assert time.monotonic() - start < 1
+
+
+def test_not_ready(mosquitto_test, mqtt_controller, mqtt_client):
+    sender = MqttSender(MQTT_HOST, MQTT_PORT, ready_timeout=5000)
+    # pretend that the connection was lost
+    sender.connected.clear()
+    sender.reply_subscribed.clear()
+
+    # the wait for the sender to be ready is bounded by the timeout of the request
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        sender.send("echo", "echo", {"request_msg": {"id": 1}}, timeout=300)
+    assert time.monotonic() - start < 1
+
+    # it is waited only once for all the requests
+    start = time.monotonic()
+    results = list(
+        sender.send_many("echo", "echo", None, [MQTT_ID] * 10, concurrency=2, timeout=300)
+    )
+    assert len(results) == 10
+    assert all(isinstance(e, (TimeoutError, ConnectionError)) for _, e in results)
+    assert time.monotonic() - start < 1
+    sender.disconnect()
+
+
+def test_single_connection(mosquitto_test, mqtt_controller, mqtt_client):
+    notifications = []
+    sender = MqttSender(MQTT_HOST, MQTT_PORT, ready_timeout=5000, single_connection=True)
+    sender.listen_notifications(
+        lambda msg, controller_id: notifications.append((controller_id, msg)), module="web"
+    )
+    # replies are received using the sender client
+    assert sender.reply_client is sender.client
+    assert not sender.reply_worker.is_alive()
+
+    response = sender.send("echo", "echo", {"request_msg": {"id": 1}})
+    assert response == {"reply_msg": {"id": 1}}
+
+    sender.send("web", "set_language", {"language": "cs"})
+    start = time.monotonic()
+    while not notifications and time.monotonic() - start < 5:
+        time.sleep(0.1)
+    assert notifications[-1] == (
+        MQTT_ID,
+        {
+            "action": "set_language",
+            "data": {"language": "cs"},
+            "kind": "notification",
+            "module": "web",
+        },
+    )
+    sender.disconnect()
+
+
+def test_mqtt5(mosquitto_test, mqtt_controller, mqtt_client):
+    from paho.mqtt import client as mqtt
+    from paho.mqtt.packettypes import PacketTypes
+    from paho.mqtt.properties import Properties
+    from foris_client.buses.mqtt import mqtt_client_extra
+
+    sender = MqttSender(MQTT_HOST, MQTT_PORT, ready_timeout=5000, protocol=mqtt.MQTTv5)
+
+    # fake controller which replies using the response topic and the correlation data
+    controller_id = "0000000000000005"
+
+    def on_message(client, userdata, msg):
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.CorrelationData = msg.properties.CorrelationData
+        client.publish(
+            msg.properties.ResponseTopic,
+            '{"module": "echo", "action": "echo", "kind": "reply", "data": {"v5": true}}',
+            properties=properties,
+        )
+
+    client = mqtt.Client(protocol=mqtt.MQTTv5, **mqtt_client_extra())
+    client.on_message = on_message
+    client.connect(MQTT_HOST, MQTT_PORT)
+    client.subscribe("foris-controller/%s/request/+/action/+" % controller_id)
+    client.loop_start()
+    client.publish(
+        "foris-controller/%s/notification/remote/action/advertize" % controller_id,
+        '{"module": "remote", "action": "advertize", "kind": "notification", '
+        '"data": {"state": "running", "id": "%s", "working_replies": []}}' % controller_id,
+    ).wait_for_publish()
+
+    assert sender.wait_ready(5000, controller_id=controller_id)
+    assert sender.send("echo", "echo", None, controller_id=controller_id) == {"v5": True}
+    assert controller_id in sender.reply_worker.v5_controllers
+    assert controller_id not in sender.reply_worker.legacy
+
+    # fallback for the controllers which reply to the legacy topics
+    response = sender.send("echo", "echo", {"request_msg": {"id": 1}}, controller_id=MQTT_ID)
+    assert response == {"reply_msg": {"id": 1}}
+    assert MQTT_ID in sender.reply_worker.legacy
+    assert "foris-controller/+/reply/+" not in sender.reply_worker.topics
+
+    # the caller is not blocked till the legacy subscription is acknowledged
+    # and the request is not sent till then (here the acknowledgement never arrives)
+    sender.reply_worker.subscribe_async = lambda topic, callback: None
+    start = time.monotonic()
+    future = sender.send_async("echo", "echo", None, timeout=300, controller_id="0000000000000006")
+    assert time.monotonic() - start < 0.1
+    with pytest.raises(TimeoutError):
+        future.result(1)
+
+    sender.disconnect()
+    client.disconnect()
+    client.loop_stop()
+
+
+def test_controller_registry(mosquitto_test, mqtt_controller, mqtt_client):
+    from paho.mqtt import client as mqtt
+    from foris_client.buses.mqtt import mqtt_client_extra
+
+    controller_id = "0000000000000002"
+    events = []
+    mqtt_client.registry.add_callback(lambda *args: events.append(args))
+
+    start = time.monotonic()
+    while MQTT_ID not in mqtt_client.registry.online() and time.monotonic() - start < 10:
+        time.sleep(0.1)
+    assert MQTT_ID in mqtt_client.registry.online()
+    assert time.time() - mqtt_client.registry.last_seen(MQTT_ID) < 10
+
+    # a single advertisement of a fake controller
+    client = mqtt.Client(**mqtt_client_extra())
+    client.connect(MQTT_HOST, MQTT_PORT)
+    client.loop_start()
+    client.publish(
+        "foris-controller/%s/notification/remote/action/advertize" % controller_id,
+        '{"module": "remote", "action": "advertize", "kind": "notification", '
+        '"data": {"state": "running", "id": "%s", "working_replies": []}}' % controller_id,
+    ).wait_for_publish()
+    client.disconnect()
+    client.loop_stop()
+
+    start = time.monotonic()
+    while (controller_id, False) not in events and time.monotonic() - start < 10:
+        time.sleep(0.1)
+    assert [e for e in events if e[0] == controller_id] == [
+        (controller_id, True),
+        (controller_id, False),
+    ]
+    assert controller_id not in mqtt_client.registry.online()
+    assert mqtt_client.registry.get(controller_id)["online"] is False
+
+
+def test_controller_missing_wakeup(mosquitto_test, mqtt_controller, mqtt_client):
+    controller_id = "0000000000000003"
+    assert mqtt_client.wait_ready(10000, controller_id=MQTT_ID)
+
+    # a single advertisement of a fake controller which never replies
+    client = mqtt.Client(**mqtt_client_extra())
+    client.connect(MQTT_HOST, MQTT_PORT)
+    client.loop_start()
+    client.publish(
+        "foris-controller/%s/notification/remote/action/advertize" % controller_id,
+        '{"module": "remote", "action": "advertize", "kind": "notification", '
+        '"data": {"state": "running", "id": "%s", "working_replies": []}}' % controller_id,
+    ).wait_for_publish()
+    client.disconnect()
+    client.loop_stop()
+    assert mqtt_client.wait_ready(10000, controller_id=controller_id)
+
+    # the request fails as soon as the controller goes offline
+    future = mqtt_client.send_async("about", "get", None, timeout=0, controller_id=controller_id)
+    with pytest.raises(ControllerMissing):
+        future.result(ANNOUNCER_PERIOD_REQUIRED + 1)
+    assert not mqtt_client.pending
+
+    # advertised after the subscription and then went offline => all the controllers are known
+    assert mqtt_client.advertisement_window_elapsed()
+
+    # controller which has never advertised itself fails right away
+    start = time.monotonic()
+    with pytest.raises(ControllerMissing):
+        mqtt_client.send("about", "get", None, controller_id="0000000000000004")
+    assert time.monotonic() - start < 0.5
+
+
+def _listen_notifications(listeners_kwargs, count):
+    from paho.mqtt import client as mqtt
+    from foris_client.buses.mqtt import mqtt_client_extra
+
+    received = [[] for _ in listeners_kwargs]
+    threads = []
+    for output, kwargs in zip(received, listeners_kwargs):
+        listener = MqttListener(
+            MQTT_HOST,
+            MQTT_PORT,
+            lambda msg, controller_id, output=output: output.append(
+                (controller_id, msg["data"]["i"], threading.current_thread().name)
+            ),
+            "shared",
+            3000,
+            **kwargs,
+        )
+        threads.append(threading.Thread(target=listener.listen))
+        threads[-1].start()
+    time.sleep(1)  # wait for the subscriptions
+
+    client = mqtt.Client(**mqtt_client_extra())
+    client.connect(MQTT_HOST, MQTT_PORT)
+    client.loop_start()
+    for i in range(count):
+        client.publish(
+            "foris-controller/%016X/notification/shared/action/test" % (i % 4),
+            '{"module": "shared", "action": "test", "kind": "notification", "data": {"i": %d}}'
+            % i,
+        ).wait_for_publish()
+    client.disconnect()
+    client.loop_stop()
+
+    for thread in threads:
+        thread.join()
+    return received
+
+
+def test_shared_listeners(mosquitto_test):
+    # notifications are split among the listeners of the group
+    first, second = _listen_notifications([{"group": "test"}, {"group": "test"}], 40)
+    assert first and second
+    assert sorted(e[1] for e in first + second) == list(range(40))
+
+    # notifications are split by controller_id and their order is kept
+    shards = _listen_notifications([{"shard": (0, 2)}, {"shard": (1, 2)}], 40)
+    assert sorted(e[1] for e in shards[0] + shards[1]) == list(range(40))
+    for index, received in enumerate(shards):
+        assert all(controller_shard(e[0], 2) == index for e in received)
+        for controller_id in {e[0] for e in received}:
+            ids = [e[1] for e in received if e[0] == controller_id]
+            assert ids == sorted(ids)
+
+
+def test_listener_dispatch(mosquitto_test):
+    (received,) = _listen_notifications([{"workers": 4, "queue_size": 100}], 40)
+    assert sorted(e[1] for e in received) == list(range(40))
+    # handler is not called from the network thread
+    assert all(e[2].startswith("foris-client-listener") for e in received)
+    # order of the notifications of a controller is kept
+    for controller_id in {e[0] for e in received}:
+        ids = [e[1] for e in received if e[0] == controller_id]
+        assert ids == sorted(ids)
+
+
 def test_notifications_request(mosquitto_test, mqtt_listener, mqtt_controller, mqtt_client):
     _, read_listener_output = mqtt_listener
     filters = [("web", "set_language")]
@@ -108,3 +482,40 @@ def test_notifications_cmd(
         u"kind": u"notification",
         u"module": u"maintain",
     }
+
+
+def test_async_requests(mosquitto_test, mqtt_listener, mqtt_controller, mqtt_client):
+    async def run():
+        async with AsyncMqttSender(MQTT_HOST, MQTT_PORT) as sender:
+            about = await sender.send("about", "get", None)
+            assert "errors" not in about
+
+            results = await asyncio.gather(
+                *[sender.send("echo", "echo", {"request_msg": {"id": i}}) for i in range(256)]
+            )
+            assert results == [{"reply_msg": {"id": i}} for i in range(256)]
+
+            with pytest.raises(ControllerError):
+                await sender.send("about", "non-existing", None)
+
+    asyncio.run(run())
+
+
+def test_async_listener(mosquitto_test, mqtt_listener, mqtt_controller, mqtt_client, mqtt_notify):
+    async def run():
+        listener = await AsyncMqttListener(MQTT_HOST, MQTT_PORT, module="test_module")
+        # wait till subscribed
+        await asyncio.sleep(0.5)
+        await asyncio.get_running_loop().run_in_executor(
+            None, mqtt_notify.notify, "test_module", "test_action", {"test_data": "test"}
+        )
+        async for msg, _ in listener:
+            await listener.disconnect()
+            return msg
+
+    assert asyncio.run(asyncio.wait_for(run(), 10)) == {
+        u"action": u"test_action",
+        u"data": {u"test_data": u"test"},
+        u"kind": u"notification",
+        u"module": u"test_module",
+    }
@@ -17,12 +17,19 @@
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 #
 
+import asyncio
+import json
 import pytest
 import random
+import statistics
 import string
+import subprocess
+import threading
+import time
+import tracemalloc
 import ubus
 
-from foris_client.buses.ubus import UbusSender
+from foris_client.buses.ubus import AsyncUbusSender, UbusListener, UbusSender
 from foris_client.buses.base import ControllerError
 
 from .fixtures import (
@@ -34,6 +41,8 @@ from .fixtures import (
     UBUS_PATH2,
     ubus_listener,
     ubus_notify,
+    ubus_slow_object,
+    SLOW_UBUS_OBJECT,
 )
 
 
@@ -53,11 +62,83 @@ def test_long_messages(ubusd_test, ubus_client):
     assert res == {"reply_msg": data}
 
 
+def test_send_stream(ubusd_test, ubus_client):
+    data = {
+        "random_characters": "".join(
+            random.choice(string.ascii_letters) for _ in range(1024 * 1024)
+        )
+    }
+    res = ubus_client.send_stream(
+        "echo", "echo", json.JSONEncoder().iterencode({"request_msg": data})
+    )
+    assert res == {"reply_msg": data}
+
+    # small data are sent in a single call
+    res = ubus_client.send_stream("echo", "echo", [b'{"request_msg": ', b'{"id": 1}}'])
+    assert res == {"reply_msg": {"id": 1}}
+
+
+@pytest.mark.parametrize("size", [1, 8, 32], ids=["1MiB", "8MiB", "32MiB"])
+def test_send_stream_memory(ubusd_test, ubus_client, size, tmp_path):
+    path = tmp_path / "data.json"
+    with path.open("w") as f:
+        json.dump({"extra": ["x" * 1023] * (size * 1024)}, f)
+
+    tracemalloc.start()
+    with path.open("rb") as f:
+        with pytest.raises(ControllerError):
+            ubus_client.send_stream("about", "get", f)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("%d MiB: peak %.2f MiB" % (size, peak / 1024 / 1024))
+
+    # bounded by the chunk size
+    assert peak < 8 * 1024 * 1024
+
+
 def test_nonexisting_module(ubusd_test, ubus_client):
     with pytest.raises(RuntimeError):
         ubus_client.send("non-existing", "get", None)
 
 
+def test_available_modules(ubusd_test, ubus_client):
+    def wait_for(condition):
+        start = time.monotonic()
+        while not condition() and time.monotonic() - start < 5:
+            time.sleep(0.05)
+        return condition()
+
+    assert {"about", "echo", "web"}.issubset(ubus_client.available_modules())
+    assert "slow" not in ubus_client.available_modules()
+
+    # fails before the data are sent
+    start = time.monotonic()
+    with pytest.raises(RuntimeError):
+        ubus_client.send("slow", "get", {"data": "x" * 1024 * 1024})
+    assert time.monotonic() - start < 0.1
+
+    process = subprocess.Popen(["python", "-c", SLOW_UBUS_OBJECT, UBUS_PATH])
+    try:
+        assert wait_for(lambda: "slow" in ubus_client.available_modules())
+    finally:
+        process.kill()
+    assert wait_for(lambda: "slow" not in ubus_client.available_modules())
+
+
+def test_new_object(ubusd_test, ubus_client):
+    assert "slow" not in ubus_client.available_modules()
+
+    # the ubus thread is busy, so the ubus.object.add event is not processed for a while
+    ubus_client.dispatcher.submit(time.sleep, 1)
+    process = subprocess.Popen(["python", "-c", SLOW_UBUS_OBJECT, UBUS_PATH])
+    try:
+        subprocess.run(["ubus", "wait_for", "foris-controller-slow", "-s", UBUS_PATH])
+        # sent right after the object was registered (the index is behind)
+        assert ubus_client.send("slow", "get", None) == {}
+    finally:
+        process.kill()
+
+
 def test_nonexisting_action(ubusd_test, ubus_client):
     with pytest.raises(RuntimeError):
         ubus_client.send("about", "non-existing", None)
@@ -89,6 +170,149 @@ def test_timeout(ubusd_test, ubus_client):
     sender.send("about", "get", None)
 
 
+def test_timeout_slow_object(ubusd_test, ubus_client, ubus_slow_object):
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        ubus_client.send("slow", "get", None, timeout=500)
+    assert time.monotonic() - start < 1.5
+
+    # single deadline for all multipart chunks and the final call
+    data = {"random_characters": "x" * (2 * 1024 * 1024)}
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        ubus_client.send("slow", "get", data, timeout=500)
+    assert time.monotonic() - start < 1.5
+
+
+def test_async_requests(ubusd_test, ubus_client):
+    async def run():
+        sender = await AsyncUbusSender(UBUS_PATH)
+        about = await sender.send("about", "get", None)
+        assert "errors" not in about
+
+        results = await asyncio.gather(
+            *[sender.send("echo", "echo", {"request_msg": {"id": i}}) for i in range(32)]
+        )
+        assert results == [{"reply_msg": {"id": i}} for i in range(32)]
+
+    asyncio.run(run())
+
+
+def test_send_async(ubusd_test, ubus_client):
+    futures = [
+        ubus_client.send_async("echo", "echo", {"request_msg": {"id": i}}) for i in range(32)
+    ]
+    failing = ubus_client.send_async("about", "non-existing", None)
+    assert [e.result() for e in futures] == [{"reply_msg": {"id": i}} for i in range(32)]
+    with pytest.raises(RuntimeError):
+        failing.result()
+
+
+def test_listener_and_senders(ubusd_test, ubus_controller, ubus_client):
+    notifications = []
+    listener = UbusListener(UBUS_PATH, lambda msg, _: notifications.append(msg), "web")
+    listen_thread = threading.Thread(target=listener.listen, daemon=True)
+    listen_thread.start()
+
+    results = {}
+
+    def send(index):
+        results[index] = [
+            ubus_client.send("echo", "echo", {"request_msg": {"id": index, "seq": i}})
+            for i in range(16)
+        ]
+
+    senders = [threading.Thread(target=send, args=(i,)) for i in range(8)]
+    for sender in senders:
+        sender.start()
+    ubus_client.send("web", "set_language", {"language": "cs"})
+    for sender in senders:
+        sender.join()
+
+    assert results == {
+        i: [{"reply_msg": {"id": i, "seq": j}} for j in range(16)] for i in range(8)
+    }
+
+    start = time.monotonic()
+    while not notifications and time.monotonic() - start < 5:
+        time.sleep(0.05)
+    assert notifications[-1] == {
+        u"action": u"set_language",
+        u"data": {u"language": u"cs"},
+        u"kind": u"notification",
+        u"module": u"web",
+    }
+
+    listener.disconnect()
+    listen_thread.join(1)
+    assert not listen_thread.is_alive()
+    # connection was shared with ubus_client
+    assert ubus.get_connected()
+
+
+def test_listener_shutdown(ubusd_test, ubus_client):
+    durations = []
+    for _ in range(5):
+        listener = UbusListener(UBUS_PATH, lambda msg, _: None)
+        listen_thread = threading.Thread(target=listener.listen, daemon=True)
+        listen_thread.start()
+        time.sleep(0.2)
+
+        start = time.monotonic()
+        listener.disconnect()
+        listen_thread.join(1)
+        durations.append(time.monotonic() - start)
+        assert not listen_thread.is_alive()
+
+    # the listen loop is woken up right away (median to cope with busy machines)
+    duration = statistics.median(durations)
+    print("shutdown took %.3f s (median)" % duration)
+    assert duration < 0.02, "shutdown took %.3f s" % duration
+
+    # the connection is still usable
+    assert "errors" not in ubus_client.send("about", "get", None)
+
+
+def test_listener_modules(ubusd_test, ubus_client):
+    notifications = []
+    listener = UbusListener(
+        UBUS_PATH, lambda msg, _: notifications.append(msg), ["test_module", "maint*"]
+    )
+    listen_thread = threading.Thread(target=listener.listen, daemon=True)
+    listen_thread.start()
+    time.sleep(0.5)
+
+    for module, action in [
+        ("web", "set_language"),
+        ("test_module", "test_action"),
+        ("test_module2", "test_action"),
+        ("maintain", "reboot_required"),
+    ]:
+        subprocess.check_call(
+            [
+                "ubus",
+                "-s",
+                UBUS_PATH,
+                "send",
+                "foris-controller-%s" % module,
+                json.dumps({"action": action}),
+            ]
+        )
+
+    start = time.monotonic()
+    while len(notifications) < 2 and time.monotonic() - start < 5:
+        time.sleep(0.05)
+    time.sleep(0.2)
+
+    listener.disconnect()
+    listen_thread.join(1)
+
+    assert notifications == [
+        {u"action": u"test_action", u"kind": u"notification", u"module": u"test_module"},
+        {u"action": u"reboot_required", u"kind": u"notification", u"module": u"maintain"},
+    ]
+
+
 def test_notifications_request(ubusd_test, ubus_controller, ubus_listener, ubus_client):
     _, read_listener_output = ubus_listener
 
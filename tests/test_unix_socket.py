@@ -17,11 +17,26 @@
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 #
 
+import asyncio
+import concurrent.futures
+import os
 import pytest
 import random
+import socket
 import string
+import struct
+import threading
+import time
+import tracemalloc
 
-from foris_client.buses.unix_socket import UnixSocketSender
+from foris_client.buses.unix_socket import (
+    AsyncUnixSocketListener,
+    AsyncUnixSocketSender,
+    UnixSocketListener,
+    UnixSocketSender,
+    UnixSocketSenderPool,
+    _is_idle_socket_alive,
+)
 from foris_client.buses.base import ControllerError
 
 from .fixtures import unix_controller, unix_socket_client, SOCK_PATH, unix_listener, unix_notify
@@ -42,6 +57,15 @@ def test_long_messages(unix_listener, unix_socket_client):
     assert res == {"reply_msg": data}
 
 
+@pytest.mark.parametrize("size", [1024, 1024 * 1024, 16 * 1024 * 1024])
+def test_response_sizes(unix_listener, unix_socket_client, size):
+    data = {"characters": (string.ascii_letters * (size // len(string.ascii_letters) + 1))[:size]}
+    start = time.monotonic()
+    res = unix_socket_client.send("echo", "echo", {"request_msg": data})
+    print(f"{size} B: {time.monotonic() - start:.3f} s")
+    assert res == {"reply_msg": data}
+
+
 def test_nonexisting_module(unix_listener, unix_socket_client):
     with pytest.raises(ControllerError):
         unix_socket_client.send("non-existing", "get", None)
@@ -63,6 +87,184 @@ def test_timeout(unix_listener, unix_socket_client):
     sender.send("about", "get", None)
 
 
+def test_send_async(unix_listener, unix_socket_client):
+    futures = [
+        unix_socket_client.send_async("echo", "echo", {"request_msg": {"id": i}}) for i in range(32)
+    ]
+    failing = unix_socket_client.send_async("about", "non-existing", None)
+    assert [e.result() for e in futures] == [{"reply_msg": {"id": i}} for i in range(32)]
+    with pytest.raises(ControllerError):
+        failing.result()
+
+
+def test_send_async_disconnect(tmp_path):
+    path = str(tmp_path / "controller.soc")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    sender = UnixSocketSender(path)
+    connection, _ = server.accept()
+
+    # controller never replies
+    in_flight = sender.send_async("about", "get", None, timeout=500)
+    queued = sender.send_async("about", "get", None)
+    time.sleep(0.1)
+    sender.disconnect()
+
+    # requests which were not sent yet are not sent on the closed connection
+    assert queued.cancelled()
+    with pytest.raises(ConnectionError):
+        sender.send_async("about", "get", None).result()
+    assert in_flight.exception(1) is not None
+
+    connection.close()
+    server.close()
+
+
+@pytest.mark.parametrize("threads", [1, 8, 64])
+def test_multiplexed(unix_listener, unix_socket_client, threads):
+    count = 256
+    sender = UnixSocketSender(SOCK_PATH, multiplexed=True)
+
+    def send(i):
+        return sender.send("echo", "echo", {"request_msg": {"id": i}})
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(send, range(count)))
+    elapsed = time.monotonic() - start
+    print(f"{threads} threads: {count / elapsed:.1f} requests/s")
+
+    assert results == [{"reply_msg": {"id": i}} for i in range(count)]
+    with pytest.raises(ControllerError):
+        sender.send("about", "non-existing", None)
+    sender.disconnect()
+
+
+def test_pool(unix_listener, unix_socket_client):
+    pool = UnixSocketSenderPool(SOCK_PATH, min_size=1, max_size=4)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(
+            executor.map(
+                lambda i: pool.send("echo", "echo", {"request_msg": {"id": i}}), range(64)
+            )
+        )
+    assert results == [{"reply_msg": {"id": i}} for i in range(64)]
+    assert pool.size <= 4
+
+    # connections closed by the other side are replaced
+    for _, sender in pool.idle:
+        sender.sock.shutdown(socket.SHUT_RDWR)
+    assert "errors" not in pool.send("about", "get", None)
+
+    with pytest.raises(ControllerError):
+        pool.send("about", "non-existing", None)
+    pool.disconnect()
+
+
+def test_idle_socket_alive():
+    import resource
+
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft <= 1100:
+        pytest.skip("Not enough file descriptors.")
+
+    ours, theirs = socket.socketpair()
+    # fd number above FD_SETSIZE (which select() can't handle)
+    sock = socket.socket(fileno=os.dup2(ours.fileno(), 1100))
+    ours.close()
+    assert _is_idle_socket_alive(sock)
+
+    # unexpected data
+    theirs.sendall(b"x")
+    assert not _is_idle_socket_alive(sock)
+    sock.recv(1)
+    assert _is_idle_socket_alive(sock)
+
+    # closed by the other side
+    theirs.close()
+    assert not _is_idle_socket_alive(sock)
+    sock.close()
+
+
+class _StandInSocket(object):
+    """ Counts the sent bytes and replies to each request with an empty reply
+
+    Memory allocated after the message was prepared till it is sent is recorded as well
+    (traced by tracemalloc).
+    """
+
+    REPLY = b'{"kind": "reply", "data": {}}'
+
+    def __init__(self):
+        self.sent = 0
+        self.prepared = 0
+        self.copied = 0
+        self.replies = bytearray()
+
+    def _sent(self, count):
+        self.sent += count
+        self.copied = max(self.copied, tracemalloc.get_traced_memory()[0] - self.prepared)
+        self.replies += struct.pack("I", len(self.REPLY)) + self.REPLY
+
+    def sendall(self, data):
+        self._sent(len(data))
+
+    def sendmsg(self, buffers):
+        count = sum(len(e) for e in buffers)
+        self._sent(count)
+        return count
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv_into(self, view, size):
+        count = min(size, len(self.replies))
+        view[:count] = self.replies[:count]
+        del self.replies[:count]
+        return count
+
+
+class _StandInSender(UnixSocketSender):
+    def connect(self, sock):
+        self.default_timeout = None
+        self.multiplexed = False
+        self.lock = threading.Lock()
+        self.sock = sock
+
+    def _prepare_message(self, module, action, data):
+        message = super()._prepare_message(module, action, data)
+        self.sock.prepared = tracemalloc.get_traced_memory()[0]
+        return message
+
+
+@pytest.mark.parametrize("size", [1024 * 1024, 16 * 1024 * 1024])
+@pytest.mark.parametrize("path", ["joined", "buffers"])
+def test_send_copies(size, path, monkeypatch):
+    if path == "joined":
+        # the header and the payload were concatenated before sending
+        monkeypatch.setattr(
+            "foris_client.buses.unix_socket._sendall_buffers",
+            lambda sock, buffers: sock.sendall(b"".join(buffers)),
+        )
+    data = {"characters": "x" * size}
+    sock = _StandInSocket()
+    sender = _StandInSender(sock)
+
+    tracemalloc.start()
+    assert sender.send("echo", "echo", data) == {}
+    tracemalloc.stop()
+    print("%s %d MiB: sent %d B, copied %d B" % (path, size // 1024 // 1024, sock.sent, sock.copied))
+
+    assert sock.sent > size
+    if path == "buffers":
+        # the serialized message is sent as it is
+        assert sock.copied < 64 * 1024
+    else:
+        assert sock.copied >= size
+
+
 def test_notifications_request(unix_listener, unix_socket_client):
     _, read_listener_output = unix_listener
     old_data = read_listener_output()
@@ -94,3 +296,204 @@ def test_notifications_cmd(unix_listener, unix_notify):
         u"kind": u"notification",
         u"module": u"maintain",
     }
+
+
+def test_listener_workers(unix_listener):
+    from foris_controller.buses.unix_socket import UnixSocketNotificationSender
+
+    path = "/tmp/foris-client-workers-notifications-test.soc"
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+    received = {}
+    lock = threading.Lock()
+
+    def handler(msg, controller_id):
+        time.sleep(0.001)
+        with lock:
+            received.setdefault(msg["module"], []).append(msg["data"]["index"])
+
+    listener = UnixSocketListener(path, handler, workers=4)
+    listen_thread = threading.Thread(target=listener.listen, daemon=True)
+    listen_thread.start()
+
+    def notify(module):
+        sender = UnixSocketNotificationSender(path)
+        for i in range(100):
+            sender.notify(module, "test_action", {"index": i})
+        sender.disconnect()
+
+    notifiers = [threading.Thread(target=notify, args=("module%d" % i,)) for i in range(8)]
+    for notifier in notifiers:
+        notifier.start()
+    for notifier in notifiers:
+        notifier.join()
+
+    start = time.time()
+    while sum(len(e) for e in received.values()) < 800 and time.time() - start < 10:
+        time.sleep(0.05)
+
+    listener.disconnect()
+    listen_thread.join(1)
+    assert not listen_thread.is_alive()
+
+    # notifications from a single connection are handled in order
+    assert received == {"module%d" % i: list(range(100)) for i in range(8)}
+
+
+def test_listener_workers_modules(unix_listener):
+    from foris_controller.buses.unix_socket import UnixSocketNotificationSender
+
+    path = "/tmp/foris-client-workers-modules-notifications-test.soc"
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+    received = {}
+    lock = threading.Lock()
+    running = [0, 0]  # current, max
+
+    def handler(msg, controller_id):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+            received.setdefault(msg["module"], []).append(msg["data"]["index"])
+
+    listener = UnixSocketListener(path, handler, workers=4)
+    listen_thread = threading.Thread(target=listener.listen, daemon=True)
+    listen_thread.start()
+
+    # a single connection (as the controller uses) carrying the notifications of several modules
+    sender = UnixSocketNotificationSender(path)
+    for i in range(25):
+        for module in range(4):
+            sender.notify("module%d" % module, "test_action", {"index": i})
+    sender.disconnect()
+
+    start = time.time()
+    while sum(len(e) for e in received.values()) < 100 and time.time() - start < 10:
+        time.sleep(0.05)
+
+    listener.disconnect()
+    listen_thread.join(1)
+    assert not listen_thread.is_alive()
+
+    # notifications of a single module are handled in order, different modules in parallel
+    assert received == {"module%d" % i: list(range(25)) for i in range(4)}
+    assert running[1] > 1
+
+
+def test_async_requests(unix_listener, unix_socket_client):
+    async def run():
+        async with AsyncUnixSocketSender(SOCK_PATH) as sender:
+            about = await sender.send("about", "get", None)
+            assert "errors" not in about
+
+            results = await asyncio.gather(
+                *[sender.send("echo", "echo", {"request_msg": {"id": i}}) for i in range(256)]
+            )
+            assert results == [{"reply_msg": {"id": i}} for i in range(256)]
+
+            with pytest.raises(ControllerError):
+                await sender.send("about", "non-existing", None)
+
+    asyncio.run(run())
+
+
+def _silent_controller(path, greeting=b""):
+    """ Controller which never replies (it can send a greeting right after a connection is made)
+    """
+
+    async def handle(reader, writer):
+        writer.write(greeting)
+        await reader.read()
+        writer.close()
+
+    return asyncio.start_unix_server(handle, path)
+
+
+def test_async_disconnect_in_flight(tmp_path):
+    path = str(tmp_path / "controller.soc")
+
+    async def run():
+        server = await _silent_controller(path)
+        sender = await AsyncUnixSocketSender(path)
+        task = asyncio.ensure_future(sender.send("about", "get", None))
+        await asyncio.sleep(0.1)
+        await sender.disconnect()
+
+        # the request in flight fails (it would wait forever otherwise)
+        with pytest.raises(ConnectionResetError):
+            await asyncio.wait_for(task, 1)
+        assert not sender.pending
+        with pytest.raises(ConnectionResetError):
+            await sender.send("about", "get", None)
+
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
+
+
+def test_async_unexpected_reply(tmp_path):
+    path = str(tmp_path / "controller.soc")
+
+    async def run():
+        server = await _silent_controller(path, struct.pack("I", 2) + b"{}")
+        sender = await AsyncUnixSocketSender(path)
+        await asyncio.sleep(0.1)
+
+        # the replies can't be paired with the requests anymore
+        with pytest.raises(ConnectionResetError):
+            await asyncio.wait_for(sender.send("about", "get", None), 1)
+        assert not sender.pending
+
+        await sender.disconnect()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
+
+
+def test_async_listener(unix_listener):
+    from foris_controller.buses.unix_socket import UnixSocketNotificationSender
+
+    path = "/tmp/foris-client-async-notifications-test.soc"
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+    async def run():
+        listener = await AsyncUnixSocketListener(path)
+
+        def notify():
+            sender = UnixSocketNotificationSender(path)
+            sender.notify("test_module", "test_action", {"test_data": "test"})
+            sender.notify("maintain", "reboot_required")
+            sender.disconnect()
+
+        await asyncio.get_running_loop().run_in_executor(None, notify)
+
+        notifications = []
+        async for msg, _ in listener:
+            notifications.append(msg)
+            if len(notifications) == 2:
+                await listener.disconnect()
+        return notifications
+
+    assert asyncio.run(asyncio.wait_for(run(), 10)) == [
+        {
+            u"action": u"test_action",
+            u"data": {u"test_data": u"test"},
+            u"kind": u"notification",
+            u"module": u"test_module",
+        },
+        {u"action": u"reboot_required", u"kind": u"notification", u"module": u"maintain"},
+    ]
@@ -0,0 +1,181 @@
+#
+# foris-client
+# Copyright (C) 2026 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import pytest
+import re
+import threading
+import time
+
+from foris_client.utils import (
+    OVERFLOW_BLOCK,
+    OVERFLOW_DROP_NEWEST,
+    OVERFLOW_DROP_OLDEST,
+    ExpiryIndex,
+    OrderedDispatcher,
+    TopicRouter,
+)
+
+
+def test_expiry_index():
+    index = ExpiryIndex()
+    assert index.earliest() is None
+    index.push(3.0, "c")
+    index.push(1.0, "a")
+    index.push(2.0, "b")
+    index.push(4.0, "a")  # refreshed (the outdated record stays in the index)
+    assert len(index) == 4
+    assert index.earliest() == 1.0
+
+    # popped in the timestamp order
+    assert list(index.pop_older(2.5)) == [(1.0, "a"), (2.0, "b")]
+    assert index.earliest() == 3.0
+
+    # the same timestamps are popped in the push order (keys are never compared)
+    index.push(5.0, ("d", None))
+    index.push(5.0, ("d", "x"))
+    assert list(index.pop_older(10.0, limit=0)) == []
+    assert list(index.pop_older(10.0, limit=2)) == [(3.0, "c"), (4.0, "a")]
+    assert list(index.pop_older(5.0)) == []  # only the older records
+    assert list(index.pop_older(10.0, limit=5)) == [(5.0, ("d", None)), (5.0, ("d", "x"))]
+    assert len(index) == 0
+    assert index.earliest() is None
+
+
+def test_topic_router():
+    routed = []
+    router = TopicRouter()
+    router.add(
+        "foris-controller/+/notification/remote/action/advertize",
+        lambda *args: routed.append(("advertize",) + args),
+    )
+    router.add("foris-controller/+/reply/+", lambda *args: routed.append(("reply",) + args))
+    router.add(
+        "foris-controller/+/notification/+/action/+",
+        lambda *args: routed.append(("notification",) + args),
+    )
+
+    assert router.route("foris-controller/0000000A00000001/reply/1234", "msg")
+    assert router.route("foris-controller/0000000A00000001/notification/remote/action/advertize", 1)
+    assert router.route("foris-controller/0000000A00000001/notification/web/action/set", 2)
+    assert not router.route("foris-controller/0000000A00000001/reply", 3)
+    assert not router.route("foris-controller/0000000A00000001/reply/1234/extra", 4)
+    assert not router.route("other/0000000A00000001/reply/1234", 5)
+    assert routed == [
+        ("reply", "0000000A00000001", "1234", "msg"),
+        ("advertize", "0000000A00000001", 1),
+        ("notification", "0000000A00000001", "web", "set", 2),
+    ]
+
+    # micro-benchmark (compared to the regex matching)
+    topics = [
+        "foris-controller/%016X/notification/module%d/action/action%d" % (i, i % 40, i % 7)
+        for i in range(1000)
+    ] * 100
+
+    def handler(controller_id, module, action, msg):
+        pass
+
+    router = TopicRouter()
+    router.add("foris-controller/+/notification/+/action/+", handler)
+    router.add("foris-controller/+/notification/remote/action/advertize", handler)
+    router.add("foris-controller/+/reply/+", handler)
+    start = time.perf_counter()
+    for topic in topics:
+        router.route(topic, None)
+    router_rate = len(topics) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for topic in topics:
+        match = re.match(
+            r"foris-controller/([^/]+)/notification/remote/action/advertize", topic
+        )
+        if not match:
+            match = re.match(
+                "foris-controller/([^/]+)/notification/([^/]+)/action/([^/]+)$", topic
+            )
+        handler(*match.groups(), None)
+    regex_rate = len(topics) / (time.perf_counter() - start)
+
+    print("router: %d msg/s, regex: %d msg/s" % (router_rate, regex_rate))
+
+
+@pytest.mark.parametrize(
+    "overflow,handled",
+    [
+        (OVERFLOW_BLOCK, list(range(8))),
+        (OVERFLOW_DROP_NEWEST, [0, 1, 2, 3]),
+        (OVERFLOW_DROP_OLDEST, [0, 5, 6, 7]),
+    ],
+)
+def test_ordered_dispatcher_overflow(overflow, handled):
+    dispatcher = OrderedDispatcher(1, "test-dispatcher", maxsize=3, overflow=overflow)
+    started, release = threading.Event(), threading.Event()
+    done = []
+
+    def task(i):
+        started.set()
+        release.wait()
+        done.append(i)
+
+    dispatcher.submit("a", lambda: task(0))
+    assert started.wait(1)
+
+    # the worker is busy so the tasks are queued
+    submitter = threading.Thread(
+        target=lambda: [dispatcher.submit("ab"[i % 2], lambda i=i: task(i)) for i in range(1, 8)]
+    )
+    submitter.start()
+    submitter.join(0.5)
+    assert dispatcher.depth == 3
+    assert submitter.is_alive() == (overflow == OVERFLOW_BLOCK)
+
+    release.set()
+    submitter.join()
+    dispatcher.shutdown()
+    assert sorted(done) == handled
+    assert dispatcher.dropped == 8 - len(handled)
+    assert dispatcher.depth == 0
+
+
+def test_ordered_dispatcher_shutdown():
+    dispatcher = OrderedDispatcher(1, "test-dispatcher")
+    dispatcher.BATCH = 2
+    release = threading.Event()
+    done = []
+
+    def task(i):
+        release.wait()
+        done.append(i)
+
+    for i in range(5):
+        assert dispatcher.submit("a", lambda i=i: task(i))
+    dispatcher.shutdown(wait=False)
+
+    # new tasks are dropped (even of the new keys)
+    assert not dispatcher.submit("a", lambda: task(5))
+    assert not dispatcher.submit("b", lambda: task(6))
+    assert dispatcher.dropped == 2
+
+    # queued tasks are run (the key is not resubmitted to the executor after the batch)
+    release.set()
+    start = time.monotonic()
+    while len(done) < 5 and time.monotonic() - start < 1:
+        time.sleep(0.01)
+    assert done == list(range(5))
+    assert dispatcher.depth == 0